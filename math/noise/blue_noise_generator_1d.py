@@ -6,8 +6,9 @@
 #                                                                            #
 ##############################################################################
 
-# This program generates a 1d blue-noise file, and saves it in a csv file.
-# The values are between 0 and s-1 where s is the size of a row.
+# This program generates a 1d blue-noise file, and saves it in a csv file,
+# or in a .npy or .noise file (cf noise_io) if the filename has one of these
+# extensions. The values are between 0 and s-1 where s is the size of a row.
 
 # HOWTO: just run the program and it will request the needed parameters.
 
@@ -24,27 +25,55 @@
 
 import random
 import math
-
-
-# The following global array, initialized in main function, will contain the
-# gaussian weights for the blur, for each value dx**2, with dx the distance.
-gauss = []
-
-# Maximum distance to consider values when blurring.
-# It is set by user input in main function.
-blur_dist = 10
+import collections
+import multiprocessing
+import json
+import time
+from array import array
+import numpy as np
+import noise_cache
+import noise_io
+import noise_rng
+
+
+# Seed of the random generator, to get reproducible files (None for a random
+# seed). Files with a seed are kept in the cache of noise_cache. Each row has
+# its own random generator, the stream ("row", number of the row) of the seed
+# (cf noise_rng), so a row does not depend on the other ones.
+SEED = None
+
+# Version of the algorithm, part of the cache keys. To be incremented when a
+# change modifies the noise generated for a given seed.
+ALGORITHM_VERSION = 3
+
+# Metrics of each file (wall time, number of swaps, of update_map calls, of
+# extremum searches and of values touched, per phase, summed over the rows)
+# are given as a dict to METRICS_CALLBACK and written as JSON in
+# METRICS_FILE when they are not None.
+METRICS_CALLBACK = None
+METRICS_FILE = None
 
 # 0: no logs, 1: some logs, 2: all logs
 LOGS = 0
 
+# Engine used to compute the rows: "numpy" computes ROWS_CHUNK rows at once
+# in a (rows, n) array, each step of the algorithm being done on all the rows
+# together, "python" is the original implementation computing one row at a
+# time with lists. Both give the same rows for the same random seed.
+ENGINE = "numpy"
+ROWS_CHUNK = 1024
+
+# Number of processes computing the chunks of ROWS_CHUNK rows. The rows are
+# the same whatever the number of processes, and they are written in order as
+# soon as they are available, with at most 2 chunks per process in memory.
+WORKERS = 1
+
 
 def main():
     """Main function : allows the user to choose the number of rows and the
        number of values per rows of blue noise.
        The user also gives a value for sigma - parameter of the Gaussian
        used in void-and-cluster algorithm."""
-    global gauss
-    global blur_dist
 
     filename = input("Filename: ")
     nb_rows = int(input("Number of rows: "))
@@ -52,24 +81,109 @@ def main():
     sigma = float(input("Sigma: "))
     blur_dist = int(input("Blur distance: "))
 
-    # Pre-computation of all Gauss weights
-    gauss = [math.exp(- dx_sq / (2 * sigma**2))
-                for dx_sq in range((nb_values//2 + 1)**2 + 1)]
-
-    file_content = ""
-    for i in range(nb_rows):
-        noise_line = blue_noise(nb_values)
-        file_content += ";".join(map(str, noise_line)) + "\n"
-        if LOGS == 1: print("Computed #" + str(i) + " row")
-
-    with open(filename, 'w') as f:
-        f.write(file_content)
-
-
-
-def blue_noise(n):
+    metrics = None
+    if METRICS_CALLBACK is not None or METRICS_FILE is not None:
+        metrics = {}
+    if SEED is not None:
+        rows = cached_blue_noise_rows(nb_rows, nb_values, sigma, blur_dist,
+                                      SEED, metrics)
+    else:
+        # Pre-computation of the Gauss weights
+        kernel = make_kernel(sigma, blur_dist)
+        rows = generate_rows(nb_rows, nb_values, kernel,
+                             noise_rng.new_seed(), metrics)
+
+    if noise_io.is_binary(filename):
+        table = noise_io.create(filename, (nb_rows, nb_values), np.uint32)
+        for (i, noise_line) in enumerate(rows):
+            table[i] = noise_line
+            if LOGS == 1: print("Computed #" + str(i) + " row")
+        table.flush()
+    else:
+        with open(filename, 'w') as f:
+            for (i, noise_line) in enumerate(rows):
+                f.write(";".join(map(str, noise_line)) + "\n")
+                if LOGS == 1: print("Computed #" + str(i) + " row")
+
+    # (the rows read from the cache have no metrics)
+    if metrics:
+        report_metrics(metrics)
+
+
+def cached_blue_noise_rows(nb_rows, nb_values, sigma, blur_dist, seed,
+                           metrics=None):
+    """Returns nb_rows rows of blue noise generated with the given parameters
+       and seed, as a (nb_rows, nb_values) uint32 array. It is read from the
+       cache of noise_cache if it has already been computed, else it is
+       computed (adding its metrics to the given metrics dict, cf
+       generate_rows) and stored in the cache."""
+
+    params = {"nb_rows": nb_rows, "nb_values": nb_values, "sigma": sigma,
+              "blur_dist": blur_dist, "seed": seed,
+              "version": ALGORITHM_VERSION}
+
+    def compute():
+        kernel = make_kernel(sigma, blur_dist)
+        return np.array(list(generate_rows(nb_rows, nb_values, kernel, seed,
+                                           metrics)), dtype=np.uint32)
+
+    return noise_cache.cached("blue_noise_1d", params, compute)
+
+
+def generate_rows(nb_rows, n, kernel, seed, metrics=None):
+    """Generates nb_rows rows of n values with the engine selected by ENGINE
+       and the given seed, and yields them one at a time, as lists. The rows
+       are computed by chunks of ROWS_CHUNK rows, in WORKERS processes."""
+
+    tasks = [(ENGINE, seed, first, min(ROWS_CHUNK, nb_rows - first), n,
+              kernel, metrics is not None)
+             for first in range(0, nb_rows, ROWS_CHUNK)]
+
+    if WORKERS <= 1:
+        for task in tasks:
+            (rows, chunk_metrics) = rows_chunk(task)
+            if metrics is not None:
+                merge_metrics(metrics, chunk_metrics)
+            yield from rows
+        return
+
+    with multiprocessing.Pool(WORKERS) as pool:
+        pending = collections.deque()
+        for task in tasks + [None] * (2 * WORKERS):
+            if task is not None:
+                pending.append(pool.apply_async(rows_chunk, (task,)))
+            if pending and (task is None or len(pending) >= 2 * WORKERS):
+                (rows, chunk_metrics) = pending.popleft().get()
+                if metrics is not None:
+                    merge_metrics(metrics, chunk_metrics)
+                yield from rows
+
+
+def rows_chunk(task):
+    """Computes the rows first to first + count - 1 (cf generate_rows) and
+       returns them with their metrics."""
+
+    (engine, seed, first, count, n, kernel, with_metrics) = task
+    metrics = {} if with_metrics else None
+    generators = [noise_rng.stream(seed, "row", row)
+                  for row in range(first, first + count)]
+    if engine == "numpy":
+        rows = blue_noise_rows(count, n, kernel, metrics, generators).tolist()
+    else:
+        rows = [blue_noise(n, kernel, metrics, generator)
+                for generator in generators]
+    return (rows, metrics)
+
+
+def blue_noise(n, kernel, metrics=None, generator=random):
     """Generates a 1d-blue noise array of n values and with values between 0
-       and n - 1, using the void-and-cluster algorithm (cf Ulichney93)."""
+       and n - 1, using the void-and-cluster algorithm (cf Ulichney93).
+       The kernel is given by make_kernel. If a metrics dict is given, the
+       metrics of the phases are added to it (cf add_metrics). The random
+       values are drawn from the given random generator."""
+
+    kernel = fit_kernel(kernel, n)
+    start = time.perf_counter()
 
     # Initialization of the dither array which will contain the noise values
     # between 0 and n - 1, initialized at 0.
@@ -86,8 +200,17 @@ def blue_noise(n):
     # We begin by adding randomly ones in pbp. This is the only
     # non-deterministic step of the process.
     nb_values = n // 10 + 1
-    add_random(nb_values, pbp, blur)
+    add_random(nb_values, pbp, blur, kernel, generator)
     if LOGS == 2: print("Generated " + str(nb_values) + " random values")
+    if metrics is not None:
+        add_metrics(metrics, "setup", start, nb_values, 0, len(kernel))
+        start = time.perf_counter()
+
+    # The extrema are found with indexes which are only updated around the
+    # modified values (cf build_index).
+    tile = index_tile(n, len(kernel))
+    clusters = build_index(pbp, blur, tile, 1)
+    voids = build_index(pbp, blur, tile, 0)
 
 
     # We then move 1 from tightest cluster to largest void until the
@@ -95,102 +218,313 @@ def blue_noise(n):
     # (in some cases I'd get infinite loops without it...)
     cpt = 0
     while cpt < n:
-        ci = tightest_cluster(pbp, blur)
-        pbp[ci] = 0
-        update_map(blur, ci, -1)
-        vi = largest_void(pbp, blur)
+        ci = index_extremum(clusters, blur, 1)
+        set_value(pbp, blur, kernel, ci, 0, (clusters, voids))
+        vi = index_extremum(voids, blur, 0)
         if ci == vi:
-            pbp[ci] = 1
-            update_map(blur, ci, 1)
+            set_value(pbp, blur, kernel, ci, 1, (clusters, voids))
             break
         else:
-            pbp[vi] = 1
-            update_map(blur, vi, 1)
+            set_value(pbp, blur, kernel, vi, 1, (clusters, voids))
         cpt += 1
         if LOGS == 2: print("#" + str(cpt) + " swap - "
             + "cluster: " + str(ci) + " - " + "void: " + str(vi))
+    if metrics is not None:
+        calls = 2 * (cpt + 1 if cpt < n else cpt)
+        add_metrics(metrics, "swaps", start, calls, calls, len(kernel),
+                    swaps=cpt)
+        start = time.perf_counter()
 
     # Phase I : we give a number to all pixels, by taking the tightest
     # cluster and removing it from a copy of the pixels map, iteratively.
     rank = nb_values - 1
     pm_copy = pbp[:]
     bm_copy = blur[:]
+    clusters_copy = (clusters[0][:], tile, 1)
     while rank >= 0:
-        i = tightest_cluster(pm_copy, bm_copy)
+        i = index_extremum(clusters_copy, bm_copy, 1)
         dither[i] = rank
         if LOGS == 2: print("Phase 1: given #" + str(rank) + " to " + str(i))
-        pm_copy[i] = 0
-        update_map(bm_copy, i, -1)
+        set_value(pm_copy, bm_copy, kernel, i, 0, (clusters_copy,))
         rank -= 1
+    if metrics is not None:
+        add_metrics(metrics, "phase_1", start, nb_values, nb_values,
+                    len(kernel))
+        start = time.perf_counter()
 
     # Phases II and III : we insert pixels in the largest voids, iteratively.
     rank = nb_values
     while rank < n:
-        i = largest_void(pbp, blur)
+        i = index_extremum(voids, blur, 0)
         dither[i] = rank
         if LOGS == 2: print("Phase 2: given #" + str(rank) + " to " + str(i))
-        pbp[i] = 1
-        update_map(blur, i, 1)
+        set_value(pbp, blur, kernel, i, 1, (voids,))
         rank += 1
+    if metrics is not None:
+        add_metrics(metrics, "phase_2", start, n - nb_values, n - nb_values,
+                    len(kernel))
 
     return dither
 
 
-def add_random(nb_values, pbp, blur):
-    """Adds nb_values random values in the pixels map."""
+def blue_noise_rows(nb_rows, n, kernel, metrics=None, generators=None):
+    """Generates nb_rows rows of 1d-blue noise like blue_noise, as a
+       (nb_rows, n) array, with NumPy: each search and each update of the
+       algorithm is done on all the rows at once. The random values of the
+       rows are drawn first, row after row, from the given random generators
+       (one per row, the random module by default), so the rows are the same
+       as with blue_noise. In the swaps, the rows which are done are masked
+       out."""
+
+    if generators is None:
+        generators = [random] * nb_rows
+
+    kernel = np.asarray(fit_kernel(kernel, n))
+    offsets = np.arange(len(kernel)) + (-len(kernel) // 2)
+    start = time.perf_counter()
+
+    dither = np.zeros((nb_rows, n), dtype=np.int64)
+    pbp = np.zeros((nb_rows, n), dtype=bool)
+    blur = np.zeros((nb_rows, n))
+
+    # The random values are drawn like add_random does, and the kernels are
+    # added in the same order to get exactly the same blur.
+    nb_values = n // 10 + 1
+    positions = np.empty((nb_rows, nb_values), dtype=np.int64)
+    for (r, generator) in enumerate(generators):
+        row = [0]*n
+        for k in range(nb_values):
+            i = generator.randrange(n)
+            while row[i]:
+                i = generator.randrange(n)
+            row[i] = 1
+            positions[r, k] = i
+    all_rows = np.arange(nb_rows)
+    for k in range(nb_values):
+        update_rows(pbp, blur, kernel, offsets, all_rows, positions[:, k], 1)
+    if LOGS == 2: print("Generated " + str(nb_values) + " random values in "
+                        + str(nb_rows) + " rows")
+    if metrics is not None:
+        add_metrics(metrics, "setup", start, nb_rows * nb_values, 0,
+                    len(kernel), rows=nb_rows)
+        start = time.perf_counter()
+
+    # Swaps, in the rows where the tightest cluster does not create the
+    # largest void yet
+    active = all_rows
+    cpt = np.zeros(nb_rows, dtype=np.int64)
+    calls = 0
+    while len(active) and cpt[active[0]] < n:
+        ci = tightest_cluster_rows(pbp[active], blur[active])
+        update_rows(pbp, blur, kernel, offsets, active, ci, -1)
+        vi = largest_void_rows(pbp[active], blur[active])
+        done = ci == vi
+        update_rows(pbp, blur, kernel, offsets, active, vi, 1)
+        calls += 2 * len(active)
+        cpt[active[~done]] += 1
+        active = active[~done]
+        if LOGS == 2: print(str(len(active)) + " rows still swapping")
+    if metrics is not None:
+        add_metrics(metrics, "swaps", start, calls, calls, len(kernel),
+                    rows=nb_rows, swaps=int(cpt.sum()))
+        start = time.perf_counter()
+
+    # Phase I
+    pm_copy = pbp.copy()
+    bm_copy = blur.copy()
+    for rank in range(nb_values - 1, -1, -1):
+        i = tightest_cluster_rows(pm_copy, bm_copy)
+        dither[all_rows, i] = rank
+        update_rows(pm_copy, bm_copy, kernel, offsets, all_rows, i, -1)
+    if metrics is not None:
+        add_metrics(metrics, "phase_1", start, nb_rows * nb_values,
+                    nb_rows * nb_values, len(kernel), rows=nb_rows)
+        start = time.perf_counter()
+
+    # Phases II and III
+    for rank in range(nb_values, n):
+        i = largest_void_rows(pbp, blur)
+        dither[all_rows, i] = rank
+        update_rows(pbp, blur, kernel, offsets, all_rows, i, 1)
+    if metrics is not None:
+        add_metrics(metrics, "phase_2", start, nb_rows * (n - nb_values),
+                    nb_rows * (n - nb_values), len(kernel), rows=nb_rows)
+
+    return dither
+
+
+def tightest_cluster_rows(pbp, blur):
+    """Returns the position of the tightest cluster of each row (the first
+       one in case of equality, like index_extremum)."""
+
+    return np.argmax(np.where(pbp, blur, -np.inf), axis=1)
+
+
+def largest_void_rows(pbp, blur):
+    """Returns the position of the largest void of each row (the first one
+       in case of equality, like index_extremum)."""
+
+    return np.argmin(np.where(pbp, np.inf, blur), axis=1)
+
+
+def update_rows(pbp, blur, kernel, offsets, rows, positions, value):
+    """Adds (value=1) or removes (value=-1) a value at the given position of
+       each of the given rows, and updates their blur like update_map."""
+
+    n = pbp.shape[1]
+    pbp[rows, positions] = value > 0
+    columns = (positions[:, None] + offsets) % n
+    blur[rows[:, None], columns] += value * kernel
+
+
+def merge_metrics(metrics, other):
+    """Adds the metrics of other to metrics."""
+
+    for (phase, counters) in other.items():
+        total = metrics.setdefault(phase, {})
+        for (name, value) in counters.items():
+            total[name] = total.get(name, 0) + value
+
+
+def add_metrics(metrics, phase, start, updates, searches, kernel_size,
+                rows=1, **counters):
+    """Adds to the metrics of the given phase the time since start (given by
+       time.perf_counter), the given numbers of calls to update_map and of
+       extremum searches, and other counters, for the given number of
+       rows."""
+
+    total = metrics.setdefault(phase, {"rows": 0, "seconds": 0,
+                                       "update_map_calls": 0,
+                                       "extremum_searches": 0,
+                                       "values_touched": 0})
+    total["rows"] += rows
+    total["seconds"] += time.perf_counter() - start
+    total["update_map_calls"] += updates
+    total["extremum_searches"] += searches
+    total["values_touched"] += updates * kernel_size
+    for (name, value) in counters.items():
+        total[name] = total.get(name, 0) + value
+
+
+def report_metrics(metrics):
+    """Gives the metrics of a file to METRICS_CALLBACK and writes them in
+       METRICS_FILE, if they are set."""
+
+    if METRICS_CALLBACK is not None:
+        METRICS_CALLBACK(metrics)
+    if METRICS_FILE is not None:
+        with open(METRICS_FILE, 'w') as f:
+            json.dump(metrics, f, indent=2)
+
+
+def add_random(nb_values, pbp, blur, kernel, generator=random):
+    """Adds nb_values random values in the pixels map, drawn from the given
+       random generator."""
 
     n = len(pbp)
 
     for _ in range(nb_values):
-        i = random.randrange(n)
+        i = generator.randrange(n)
         while pbp[i]:
-            i = random.randrange(n)
+            i = generator.randrange(n)
         pbp[i] = 1
-        update_map(blur, i, 1)
+        update_map(blur, kernel, i, 1)
 
 
 
-def tightest_cluster(pbp, blur):
-    """Finds the tightest cluster using a Gaussian.
-       Blurs the pixels map and finds its maximum."""
+def index_tile(n, kernel_size):
+    """Returns the size of the tiles of the extremum indexes for arrays of n
+       values: about sqrt(n), but not smaller than the kernel."""
 
-    n = len(pbp)
+    return max(kernel_size, math.isqrt(n), 1)
 
-    vmax = -1 # A value smaller than all possible values
-    im = 0
 
-    for i in range(n):
-        if pbp[i] and blur[i] > vmax:
-            vmax = blur[i]
+def build_index(pbp, blur, tile, ones):
+    """Builds an extremum index of the values of pbp equal to ones: for each
+       tile of `tile` consecutive values, the position of its tightest
+       cluster (ones=1) or largest void (ones=0), or -1 if there is none.
+       As update_map only changes a window around a value, only the tiles of
+       this window have to be recomputed after each update."""
+
+    index = [-1] * ((len(pbp) + tile - 1) // tile)
+    for k in range(len(index)):
+        refresh_tile(index, pbp, blur, tile, k, ones)
+    return (index, tile, ones)
+
+
+def refresh_tile(index, pbp, blur, tile, k, ones):
+    """Recomputes the extremum of the k-th tile of an index."""
+
+    im = -1
+    for i in range(k * tile, min(len(pbp), (k + 1) * tile)):
+        if pbp[i] == ones and (im < 0
+                               or (ones and blur[i] > blur[im])
+                               or (not ones and blur[i] < blur[im])):
             im = i
-    return im
+    index[k] = im
 
 
+def index_extremum(index, blur, ones):
+    """Finds the tightest cluster (ones=1) or the largest void (ones=0)
+       with the given index, in O(number of tiles): the maximum (or minimum)
+       of the blur among the values equal to ones, the first one in case of
+       equality."""
+
+    im = -1
+    for i in index[0]:
+        if i >= 0 and (im < 0
+                       or (ones and blur[i] > blur[im])
+                       or (not ones and blur[i] < blur[im])):
+            im = i
+    return max(im, 0)
+
 
-def largest_void(pbp, blur):
-    """Finds the largest void using a Gaussian.
-       Blurs the pixels map and finds its minimum."""
+def set_value(pbp, blur, kernel, i, value, indexes):
+    """Sets pbp[i] to value, updates the blur map and refreshes the tiles of
+       the given indexes which have been modified."""
 
     n = len(pbp)
+    pbp[i] = value
+    update_map(blur, kernel, i, 1 if value else -1)
 
-    vmin = n+1 # A value greater than all possible values
-    im = 0
+    for (index, tile, ones) in indexes:
+        # The tile of i itself is not in the window of a kernel of size 1
+        tiles = set(((i + ki + (-len(kernel) // 2)) % n) // tile
+                    for ki in range(len(kernel)))
+        tiles.add(i // tile)
+        for k in tiles:
+            refresh_tile(index, pbp, blur, tile, k, ones)
 
-    for i in range(n):
-        if (not pbp[i]) and blur[i] < vmin:
-            vmin = blur[i]
-            im = i
-    return im
+
+def make_kernel(sigma, blur_dist):
+    """Returns the gaussian weights used for the blur in a typed array of
+       blur_dist values. The element 0 is the weight of the offset
+       -blur_dist // 2, like the loop of update_map. The kernel does not
+       depend on the number of values, so it can be reused for all rows."""
+
+    return array('d', [math.exp(- dx**2 / (2 * sigma**2))
+                       for dx in range(-blur_dist // 2, blur_dist // 2)])
+
+
+def fit_kernel(kernel, n):
+    """Returns the part of the kernel with at most n offsets, when the rows
+       are shorter than the kernel."""
+
+    k = min(n, len(kernel))
+    i0 = (-k // 2) - (-len(kernel) // 2)
+    return kernel[i0:i0 + k]
 
 
-def update_map(blur, i, value):
+def update_map(blur, kernel, i, value):
     """Gives the new blur map when adding (value=1) or removing (value=-1)
-       a pixel at position (i, j)."""
+       a pixel at position i."""
 
     n = len(blur)
+    i0 = i + (-len(kernel) // 2)
 
-    for ki in range(-min(n, blur_dist) // 2, min(n, blur_dist) // 2):
-        blur[(i + ki) % n] += value * gauss[ki**2]
+    for ki in range(len(kernel)):
+        blur[(i0 + ki) % n] += value * kernel[ki]
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,11 @@
 # generation, etc.
 
 # HOWTO: just run the program and it will request the needed parameters.
-# For the moment it can only generate a PNG image.
+# The texture is saved as a PNG image, or as a table of ranks in a .npy or
+# .noise file (cf noise_io) if the filename has one of these extensions.
+# With CHANNELS > 1, several independent textures are generated at once, and
+# saved as the channels of one image (up to 4: grey+alpha, RGB or RGBA) or
+# as a (height, width, channels) table.
 
 
 # Note : using a sigma value of 1.5 works perfectly, and it is a tip given by
@@ -25,48 +29,234 @@
 import png
 import random
 import math
+import os
+import json
+import time
+import multiprocessing
+import contextlib
+import numpy as np
+import noise_cache
+import noise_io
+import noise_analysis
+import noise_rng
 
 
-# The following global array, initialized in main function, will contain the
-# gaussian weights for the blur, for each value r**2, with r the distance.
-gauss = []
+# Seed of the random generator, to get reproducible textures (None for a
+# random seed). Textures with a seed are kept in the cache of noise_cache.
+# The random pattern is drawn from the stream "pattern" of the seed (cf
+# noise_rng).
+SEED = None
 
-# Maximum distance to consider pixels when blurring (on each axis)
-# It is set by user input in main function
-blur_dist = 10
+# Version of the algorithm, part of the cache keys. To be incremented when a
+# change modifies the textures generated for a given seed.
+ALGORITHM_VERSION = 2
 
 # True if you want the program to print logs, False if not.
 # Logs can be useful when you try to compute very wide textures.
 LOGS = False
 
+# Metrics of each run (wall time, number of swaps, of update_map calls, of
+# extremum searches and of pixels touched, per phase) are given as a dict to
+# METRICS_CALLBACK and written as JSON in METRICS_FILE when they are not
+# None. They are only computed at the end of each phase.
+METRICS_CALLBACK = None
+METRICS_FILE = None
+
+# Side of the square tiles of the extremum indexes used by the NumPy engine
+# (cf build_index_np).
+TILE_SIZE = 16
+
+# Engine used to compute the texture: "numpy" works on contiguous arrays and
+# is much faster, "python" is the original implementation working on lists.
+# Both give the same texture for the same random seed (if FFT_INIT and
+# RESYNC_STEPS are disabled).
+ENGINE = "numpy"
+
+# True to compute the initial blur map of the NumPy engine with one FFT
+# convolution, instead of adding the random pixels one by one. It is much
+# faster for big textures, but the result differs by rounding errors, which
+# can break ties between pixels differently: the texture is then not the one
+# of the "python" engine.
+FFT_INIT = False
+
+# If not 0, the NumPy engine recomputes its blur maps with a FFT convolution
+# every RESYNC_STEPS steps, to bound the drift of the rounding errors of the
+# incremental updates.
+RESYNC_STEPS = 0
+
+# Number of pixels inserted at once in Phases II and III by the NumPy engine.
+# 1 is the exact void-and-cluster algorithm. With a bigger value, the largest
+# voids of different tiles are inserted together, skipping the ones closer
+# than BATCH_MIN_DIST pixels to a void of the batch: this is much faster for
+# big textures, but the quality is a bit lower (the lower BATCH_MIN_DIST, the
+# bigger the batches and the lower the quality). The quality is then given by
+# spectral_quality in the metrics, if they are reported. The texture also
+# depends on TILE_SIZE, as the voids of a batch are taken in different tiles.
+BATCH_SIZE = 1
+BATCH_MIN_DIST = 8
+
+# Tiled schedule of Phases I, II and III of the NumPy engine, for WORKERS
+# processes (or in the main process if WORKERS is 1). With PARALLEL_TILES,
+# the torus is split in tiles of at least
+# PARALLEL_TILE pixels (and at least the kernel) per side, in 4 groups such
+# that two tiles of a group are never neighbours: the windows modified around
+# the pixels of a tile then only overlap the neighbouring tiles (its halo),
+# which belong to other groups. The tiles of a group are processed together,
+# each one removing its PARALLEL_STEPS tightest clusters (Phase I) or filling
+# its PARALLEL_STEPS largest voids (Phases II and III) in the maps shared by
+# the processes, and the groups take turns, so that each tile sees the
+# updates of its halo between two turns. The result is an approximation of
+# the serial algorithm, which only depends on the seed (not on the number of
+# processes): WORKERS only changes the speed. The tiled schedule is not used
+# with MMAP_DIR, and no checkpoints are saved during these phases.
+PARALLEL_TILES = False
+WORKERS = 1
+PARALLEL_TILE = 32
+PARALLEL_STEPS = 8
+
+# Number of independent textures (channels) generated in one run, with the
+# same kernel (cf generate_channels). The channel c is generated from the
+# seed derived from the seed and ("channel", c) (cf noise_rng). The channels
+# are distributed among the WORKERS processes, unless the phases of each
+# channel follow the tiled schedule (cf PARALLEL_TILES). The channels are the
+# same whatever the number of processes. Checkpoints are only available with
+# one channel.
+CHANNELS = 1
+
+# Directory where the NumPy engine keeps its maps in memory-mapped .npy files
+# instead of memory, for textures which do not fit in RAM: ranks.npy (uint32),
+# pixels.npy (uint8) and blur.npy (float32). None to work in memory.
+MMAP_DIR = None
+
+# Counters saved in the checkpoints, besides the maps
+COUNTERS = ("phase", "step", "cpt", "rank", "nb_values")
+
+# File where the NumPy engine saves its state every CHECKPOINT_STEPS steps,
+# so that an interrupted run can be resumed with resume_blue_noise. The
+# resumed run gives exactly the same texture. None to disable checkpoints.
+CHECKPOINT_FILE = None
+CHECKPOINT_STEPS = 100000
+
 
 def main():
     """Main function : allows the user to choose the dimensions of the
        resulting texture and the filename, computes it and saves it.
        The user also gives a value for sigma - parameter of the Gaussian
        used in void-and-cluster algorithm."""
-    global gauss
-    global blur_dist
 
     filename = input("Filename: ")
+
+    if (ENGINE == "numpy" and CHECKPOINT_FILE is not None and CHANNELS == 1
+            and os.path.exists(CHECKPOINT_FILE)
+            and input("Resume the interrupted run (y/n)? ") == "y"):
+        save_texture(resume_blue_noise(CHECKPOINT_FILE), filename)
+        return
+
     width = int(input("Width: "))
     height = int(input("Height: "))
     sigma = float(input("Sigma: "))
     blur_dist = int(input("Blur distance: "))
 
-    # Pre-computation of all Gauss weights
-    gauss = [math.exp(- r_sq / (2 * sigma**2))
-                for r_sq in range((width//2 + 1)**2 + (height//2 + 1)**2 + 1)]
+    if SEED is not None:
+        noise_map = cached_blue_noise(width, height, sigma, blur_dist, SEED)
+    else:
+        # Pre-computation of the Gauss weights
+        kernel = make_kernel(sigma, blur_dist)
+        if CHANNELS > 1:
+            noise_map = generate_channels(width, height, kernel,
+                                          noise_rng.new_seed(), CHANNELS)
+        else:
+            noise_map = generate(width, height, kernel, noise_rng.new_seed())
+
+    save_texture(noise_map, filename)
+
+
+def generate(width, height, kernel, seed):
+    """Generates a texture with the engine selected by ENGINE and the given
+       seed."""
+
+    generator = noise_rng.stream(seed, "pattern")
+    if ENGINE == "numpy":
+        return blue_noise_np(width, height, kernel, generator)
+    else:
+        return blue_noise(width, height, kernel, generator)
+
+
+def generate_channels(width, height, kernel, seed, channels):
+    """Generates the given number of independent textures with the same
+       kernel, and returns them as a (height, width, channels) uint32 array.
+       Each channel is computed by generate with its own seed (cf CHANNELS),
+       so the result does not depend on the number of processes."""
+
+    if CHECKPOINT_FILE is not None:
+        raise ValueError("Checkpoints are not available with several channels")
+
+    if MMAP_DIR is None:
+        noise_map = np.empty((height, width, channels), dtype=np.uint32)
+    else:
+        noise_map = mapped_array("channels", (height, width, channels),
+                                 np.uint32, 0)
+
+    tasks = [(width, height, kernel, noise_rng.derive(seed, "channel", c))
+             for c in range(channels)]
+    parallel_phases = parallel_tiles((height, width),
+                                     fit_kernel(kernel, width, height))
+    if WORKERS <= 1 or MMAP_DIR is not None or parallel_phases is not None:
+        # The memory-mapped files of the maps are reused by each channel,
+        # and the tiled phases have their own processes
+        for (c, task) in enumerate(tasks):
+            noise_map[:, :, c] = channel_texture(task)
+    else:
+        with multiprocessing.Pool(min(WORKERS, channels)) as pool:
+            for (c, texture) in enumerate(pool.imap(channel_texture, tasks)):
+                noise_map[:, :, c] = texture
+    return noise_map
+
+
+def channel_texture(task):
+    """Generates the texture of a channel (cf generate_channels)."""
+
+    (width, height, kernel, seed) = task
+    return np.asarray(generate(width, height, kernel, seed), dtype=np.uint32)
 
-    noise_map = blue_noise(width, height)
-    
-    save_image(noise_map, filename)
 
+def cached_blue_noise(width, height, sigma, blur_dist, seed):
+    """Returns the texture generated with the given parameters and seed, as
+       a uint32 array (with a third dimension for the channels if CHANNELS is
+       bigger than 1). It is read from the cache of noise_cache if it has
+       already been computed, else it is computed and stored in the cache."""
 
-def blue_noise(width, height):
+    params = {"width": width, "height": height, "sigma": sigma,
+              "blur_dist": blur_dist, "seed": seed,
+              "version": ALGORITHM_VERSION, "engine": ENGINE,
+              "fft_init": FFT_INIT, "resync_steps": RESYNC_STEPS,
+              "float32": MMAP_DIR is not None, "batch_size": BATCH_SIZE,
+              "batch_min_dist": BATCH_MIN_DIST,
+              "parallel": (None if not PARALLEL_TILES or MMAP_DIR is not None
+                           else [PARALLEL_TILE, PARALLEL_STEPS]),
+              "channels": CHANNELS}
+    if BATCH_SIZE > 1:
+        params["tile_size"] = TILE_SIZE
+
+    def compute():
+        kernel = make_kernel(sigma, blur_dist)
+        if CHANNELS > 1:
+            return generate_channels(width, height, kernel, seed, CHANNELS)
+        noise_map = generate(width, height, kernel, seed)
+        return np.asarray(noise_map, dtype=np.uint32)
+
+    return noise_cache.cached("blue_noise_2d", params, compute)
+
+
+def blue_noise(width, height, kernel, generator=random):
     """Generates a blue noise matrix of given width and heights and with
        values between 0 and width*height - 1, using the void-and-cluster
-       algorithm (cf Ulichney93 paper)."""
+       algorithm (cf Ulichney93 paper). The kernel is given by make_kernel,
+       and the random pattern is drawn from the given random generator."""
+
+    kernel = fit_kernel(kernel, width, height).tolist()
+    kernel_size = len(kernel) * len(kernel[0])
+    start = time.perf_counter()
 
     # Initialization of the width*height dither map which will contain the
     # noise values between 0 and width*height - 1, initialized at 0.
@@ -83,29 +273,41 @@ def blue_noise(width, height):
     # We begin by adding randomly pixels in pixel map. This is the only
     # non-deterministic step of the process.
     nb_values = (width*height) // 8
-    add_random(nb_values, pixels_map, blur_map)
+    add_random(nb_values, pixels_map, blur_map, kernel, generator)
     if LOGS: print("Generated " + str(nb_values) + " random values")
+    metrics = {"setup": phase_metrics(start, nb_values, 0, kernel_size)}
+    start = time.perf_counter()
+
+    # The extrema are found with indexes which are only updated around the
+    # modified pixels (cf build_index).
+    tile = index_tile(width, height, kernel)
+    clusters = build_index(pixels_map, blur_map, tile, 1)
+    voids = build_index(pixels_map, blur_map, tile, 0)
 
 
     # We then move pixel from tightest cluster to largest void until the
-    # tightest cluster creates largest void.
+    # tightest cluster creates largest void, or cpt gets too high (with
+    # ties, the swaps can cycle forever).
     cpt = 0
-    while True:
-        (ci, cj) = tightest_cluster(pixels_map, blur_map)
-        pixels_map[ci][cj] = 0
-        update_map(blur_map, ci, cj, -1)
-        (vi, vj) = largest_void(pixels_map, blur_map)
+    while cpt < width*height:
+        (ci, cj) = index_extremum(clusters, blur_map)
+        set_pixel(pixels_map, blur_map, kernel, ci, cj, 0, (clusters, voids))
+        (vi, vj) = index_extremum(voids, blur_map)
         if ci == vi and cj == vj:
-            pixels_map[ci][cj] = 1
-            update_map(blur_map, ci, cj, 1)
+            set_pixel(pixels_map, blur_map, kernel, ci, cj, 1,
+                      (clusters, voids))
             break
         else:
-            pixels_map[vi][vj] = 1
-            update_map(blur_map, vi, vj, 1)
+            set_pixel(pixels_map, blur_map, kernel, vi, vj, 1,
+                      (clusters, voids))
         cpt += 1
         if LOGS: print("#" + str(cpt) + " swap - "
             + "cluster: (" + str(ci) + ", " + str(cj) + ") - "
             + "void: (" + str(vi) + ", " + str(vj) + ")")
+    calls = 2 * (cpt + 1 if cpt < width*height else cpt)
+    metrics["swaps"] = phase_metrics(start, calls, calls, kernel_size,
+                                     swaps=cpt)
+    start = time.perf_counter()
 
 
     # Phase I : we give a number to all pixels, by taking the tightest
@@ -113,112 +315,996 @@ def blue_noise(width, height):
     rank = nb_values - 1
     pm_copy = [pixels_map[i][:] for i in range(height)]
     bm_copy = [blur_map[i][:] for i in range(height)]
+    clusters_copy = ([row[:] for row in clusters[0]], tile, 1)
     while rank >= 0:
-        (i, j) = tightest_cluster(pm_copy, bm_copy)
+        (i, j) = index_extremum(clusters_copy, bm_copy)
         dither_map[i][j] = rank
         if LOGS: print("Phase 1: given #" + str(rank)
             + " to (" + str(i) + ", " + str(j) + ")")
-        pm_copy[i][j] = 0
-        update_map(bm_copy, i, j, -1)
+        set_pixel(pm_copy, bm_copy, kernel, i, j, 0, (clusters_copy,))
         rank -= 1
+    metrics["phase_1"] = phase_metrics(start, nb_values, nb_values,
+                                       kernel_size)
+    start = time.perf_counter()
 
     # Phases II and III : we insert pixels in the largest voids, iteratively.
     rank = nb_values
     while rank < width*height:
-        (i, j) = largest_void(pixels_map, blur_map)
+        (i, j) = index_extremum(voids, blur_map)
         dither_map[i][j] = rank
         if LOGS: print("Phase 2: given #" + str(rank)
             + " to (" + str(i) + ", " + str(j) + ")")
-        pixels_map[i][j] = 1
-        update_map(blur_map, i, j, 1)
+        set_pixel(pixels_map, blur_map, kernel, i, j, 1, (voids,))
         rank += 1
+    metrics["phase_2"] = phase_metrics(start, width*height - nb_values,
+                                       width*height - nb_values, kernel_size)
+    report_metrics(metrics)
 
     return dither_map
 
 
-def add_random(nb_values, pixels_map, blur_map):
-    """Adds nb_values random values in the pixels map."""
+def phase_metrics(start, updates, searches, kernel_size, **counters):
+    """Returns the metrics of a phase started at the given time (given by
+       time.perf_counter), with the given numbers of calls to update_map and
+       of extremum searches, and other counters."""
+
+    metrics = {"seconds": time.perf_counter() - start,
+               "update_map_calls": updates,
+               "extremum_searches": searches,
+               "pixels_touched": updates * kernel_size}
+    metrics.update(counters)
+    return metrics
+
+
+def report_metrics(metrics):
+    """Gives the metrics of a run to METRICS_CALLBACK and writes them in
+       METRICS_FILE, if they are set."""
+
+    if METRICS_CALLBACK is not None:
+        METRICS_CALLBACK(metrics)
+    if METRICS_FILE is not None:
+        with open(METRICS_FILE, 'w') as f:
+            json.dump(metrics, f, indent=2)
+
+
+def add_random(nb_values, pixels_map, blur_map, kernel, generator=random):
+    """Adds nb_values random values in the pixels map, drawn from the given
+       random generator."""
 
     width = len(pixels_map[0])
     height = len(pixels_map)
 
     for _ in range(nb_values):
-        i = random.randrange(height)
-        j = random.randrange(width)
+        i = generator.randrange(height)
+        j = generator.randrange(width)
         while pixels_map[i][j]:
-            i = random.randrange(height)
-            j = random.randrange(width)
+            i = generator.randrange(height)
+            j = generator.randrange(width)
         pixels_map[i][j] = 1
-        update_map(blur_map, i, j, 1)
+        update_map(blur_map, kernel, i, j, 1)
 
 
 
-def tightest_cluster(pixels_map, blur_map):
-    """Finds the tightest cluster using a Gaussian.
-       Blurs the pixels map and finds its maximum."""
+def index_tile(width, height, kernel):
+    """Returns the side of the square tiles of the extremum indexes of the
+       list engine: about the fourth root of the number of pixels, so that a
+       search (one value per tile) and an update (the few tiles covered by
+       the kernel) cost about as much, but not smaller than the kernel."""
 
-    width = len(pixels_map[0])
-    height = len(pixels_map)
+    return max(len(kernel), len(kernel[0]), math.isqrt(math.isqrt(width
+                                                                  * height)))
+
+
+def build_index(pixels_map, blur_map, tile, ones):
+    """Builds an extremum index of the pixels equal to ones: for each tile
+       of tile x tile pixels, the position of its tightest cluster (ones=1)
+       or largest void (ones=0), or None if there is none. As update_map
+       only changes a window around a pixel, only the tiles of this window
+       have to be recomputed after each update (cf set_pixel)."""
+
+    nti = (len(pixels_map) + tile - 1) // tile
+    ntj = (len(pixels_map[0]) + tile - 1) // tile
+    index = [[None] * ntj for _ in range(nti)]
+    for ti in range(nti):
+        for tj in range(ntj):
+            refresh_tile(index, pixels_map, blur_map, tile, ti, tj, ones)
+    return (index, tile, ones)
+
+
+def refresh_tile(index, pixels_map, blur_map, tile, ti, tj, ones):
+    """Recomputes the extremum of the tile (ti, tj) of an index. The first
+       one in reading order is taken in case of equality."""
 
-    vmax = -1 # A value smaller than all possible values
-    im = 0
-    jm = 0
+    best = None
+    vbest = 0
+    for i in range(ti * tile, min(len(pixels_map), (ti + 1) * tile)):
+        pixels_row = pixels_map[i]
+        blur_row = blur_map[i]
+        for j in range(tj * tile, min(len(pixels_row), (tj + 1) * tile)):
+            if pixels_row[j] == ones and (best is None
+                                          or (ones and blur_row[j] > vbest)
+                                          or (not ones
+                                              and blur_row[j] < vbest)):
+                best = (i, j)
+                vbest = blur_row[j]
+    index[ti][tj] = best
 
-    for i in range(height):
-        for j in range(width):
-            if pixels_map[i][j] and blur_map[i][j] > vmax:
-                vmax = blur_map[i][j]
-                im = i
-                jm = j
-    return im, jm
 
+def index_extremum(index, blur_map):
+    """Finds the tightest cluster (ones=1) or the largest void (ones=0) with
+       the given index, in O(number of tiles): the maximum (or minimum) of
+       the blur map among the pixels equal to ones, the first one in reading
+       order in case of equality, or (0, 0) if there is none."""
 
+    (tiles, _, ones) = index
+    best = None
+    vbest = 0
+    for row in tiles:
+        for position in row:
+            if position is None:
+                continue
+            value = blur_map[position[0]][position[1]]
+            if (best is None or (ones and value > vbest)
+                    or (not ones and value < vbest)
+                    or (value == vbest and position < best)):
+                best = position
+                vbest = value
+    return best if best is not None else (0, 0)
 
-def largest_void(pixels_map, blur_map):
-    """Finds the largest void using a Gaussian.
-       Blurs the pixels map and finds its minimum."""
+
+def set_pixel(pixels_map, blur_map, kernel, i, j, value, indexes):
+    """Sets the pixel (i, j) to value, updates the blur map and refreshes the
+       tiles of the given indexes which have been modified."""
 
     width = len(pixels_map[0])
     height = len(pixels_map)
+    kh = len(kernel)
+    kw = len(kernel[0])
+    pixels_map[i][j] = value
+    update_map(blur_map, kernel, i, j, 1 if value else -1)
 
-    vmin = width*height+1 # A value greater than all possible values
-    im = 0
-    jm = 0
-
-    for i in range(height):
-        for j in range(width):
-            if (not pixels_map[i][j]) and blur_map[i][j] < vmin:
-                vmin = blur_map[i][j]
-                im = i
-                jm = j
-    return im, jm
+    for (index, tile, ones) in indexes:
+        # The tile of (i, j) itself is not in the window of a kernel of
+        # size 1
+        row_tiles = set(((i + ki + (-kh // 2)) % height) // tile
+                        for ki in range(kh)) | {i // tile}
+        col_tiles = set(((j + kj + (-kw // 2)) % width) // tile
+                        for kj in range(kw)) | {j // tile}
+        for ti in row_tiles:
+            for tj in col_tiles:
+                refresh_tile(index, pixels_map, blur_map, tile, ti, tj, ones)
 
 
-def update_map(blur_map, i, j, value):
+def update_map(blur_map, kernel, i, j, value):
     """Gives the new blur map when adding (value=1) or removing (value=-1)
        a pixel at position (i, j)."""
 
     width = len(blur_map[0])
     height = len(blur_map)
+    kh = len(kernel)
+    kw = len(kernel[0])
+
+    for ki in range(kh):
+        row = blur_map[(i + ki + (-kh // 2)) % height]
+        for kj in range(kw):
+            row[(j + kj + (-kw // 2)) % width] += value * kernel[ki][kj]
+
+
+def blue_noise_np(width, height, kernel, generator=random):
+    """Same as blue_noise, but the maps are stored in NumPy arrays, and the
+       searches and updates are done on whole arrays instead of pixel by
+       pixel. Returns a (height, width) array."""
+
+    kernel = fit_kernel(kernel, width, height)
+    start = time.perf_counter()
+
+    if MMAP_DIR is None:
+        dither_map = np.full((height, width), height*width-1, dtype=np.int64)
+        pixels_map = np.zeros((height, width), dtype=bool)
+        blur_map = np.zeros((height, width), dtype=np.float64)
+    else:
+        dither_map = mapped_array("ranks", (height, width), np.uint32,
+                                  height*width-1)
+        pixels_map = mapped_array("pixels", (height, width), np.uint8, 0)
+        blur_map = mapped_array("blur", (height, width), np.float32, 0)
+
+    nb_values = (width*height) // 8
+    add_random_np(nb_values, pixels_map, blur_map, kernel, generator)
+    if LOGS: print("Generated " + str(nb_values) + " random values")
+
+    metrics = {"setup": phase_metrics(start, 0 if FFT_INIT else nb_values, 0,
+                                      kernel.size)}
+
+    return run_phases_np({"phase": 0, "step": 0, "cpt": 0, "rank": 0,
+                          "nb_values": nb_values, "kernel": kernel,
+                          "dither_map": dither_map, "pixels_map": pixels_map,
+                          "blur_map": blur_map, "metrics": metrics})
+
+
+def resume_blue_noise(filename):
+    """Resumes the run of blue_noise_np saved in the given checkpoint file,
+       and returns the resulting texture."""
+
+    return run_phases_np(load_checkpoint(filename))
+
+
+def run_phases_np(state):
+    """Runs the phases of blue_noise_np from the given state: the current
+       phase (0 for the initial swaps, 1 and 2 for Phases I and II/III),
+       the counters, the kernel and the maps."""
+
+    kernel = state["kernel"]
+    dither_map = state["dither_map"]
+    pixels_map = state["pixels_map"]
+    blur_map = state["blur_map"]
+    nb_values = state["nb_values"]
+    step = state["step"]
+    (height, width) = dither_map.shape
+    metrics = state.setdefault("metrics", {})
+    start = time.perf_counter()
+
+    # The extrema are found with indexes which are only updated around the
+    # modified pixels, instead of scanning the whole maps.
+    if state["phase"] < 2:
+        clusters = build_index_np(pixels_map, blur_map, True)
+    voids = build_index_np(pixels_map, blur_map, False)
+
+    if state["phase"] == 0:
+        cpt = state["cpt"]
+        (first_cpt, first_step) = (cpt, step)
+        # (cf blue_noise for the limit of swaps)
+        while cpt < width*height:
+            (ci, cj) = index_extremum_np(clusters)
+            set_pixel_np(pixels_map, blur_map, kernel, ci, cj, -1,
+                         (clusters, voids))
+            (vi, vj) = index_extremum_np(voids)
+            if ci == vi and cj == vj:
+                set_pixel_np(pixels_map, blur_map, kernel, ci, cj, 1,
+                             (clusters, voids))
+                break
+            else:
+                set_pixel_np(pixels_map, blur_map, kernel, vi, vj, 1,
+                             (clusters, voids))
+            cpt += 1
+            if LOGS: print("#" + str(cpt) + " swap - "
+                + "cluster: (" + str(ci) + ", " + str(cj) + ") - "
+                + "void: (" + str(vi) + ", " + str(vj) + ")")
+            step += 1
+            if RESYNC_STEPS and step % RESYNC_STEPS == 0:
+                resync_np(pixels_map, blur_map, kernel, (clusters, voids))
+            if CHECKPOINT_FILE and step % CHECKPOINT_STEPS == 0:
+                state.update(step=step, cpt=cpt)
+                save_checkpoint(CHECKPOINT_FILE, state)
+
+        calls = 2 * (cpt - first_cpt + (1 if cpt < width*height else 0))
+        metrics["swaps"] = phase_metrics(
+            start, calls, calls, kernel.size, swaps=cpt - first_cpt,
+            resyncs=nb_resyncs(first_step, step))
+        start = time.perf_counter()
+
+        # Phase I
+        # (in memory-mapped mode, the copies are copy-on-write mappings of
+        # the files: only the modified pages are copied in memory)
+        if MMAP_DIR is None:
+            state["pm_copy"] = pixels_map.copy()
+            state["bm_copy"] = blur_map.copy()
+        else:
+            pixels_map.flush()
+            blur_map.flush()
+            state["pm_copy"] = np.load(os.path.join(MMAP_DIR, "pixels.npy"),
+                                       mmap_mode="c")
+            state["bm_copy"] = np.load(os.path.join(MMAP_DIR, "blur.npy"),
+                                       mmap_mode="c")
+        state.update(phase=1, rank=nb_values - 1)
+
+    if state["phase"] == 1:
+        rank = state["rank"]
+        (first_rank, first_step) = (rank, step)
+        pm_copy = state["pm_copy"]
+        bm_copy = state["bm_copy"]
+        if parallel_tiles(dither_map.shape, kernel) is not None:
+            rank = parallel_phase(pm_copy, bm_copy, kernel, dither_map, rank,
+                                  True)
+        else:
+            clusters = build_index_np(pm_copy, bm_copy, True)
+        while rank >= 0:
+            (i, j) = index_extremum_np(clusters)
+            dither_map[i, j] = rank
+            if LOGS: print("Phase 1: given #" + str(rank)
+                + " to (" + str(i) + ", " + str(j) + ")")
+            set_pixel_np(pm_copy, bm_copy, kernel, i, j, -1, (clusters,))
+            rank -= 1
+            step += 1
+            if RESYNC_STEPS and step % RESYNC_STEPS == 0:
+                resync_np(pm_copy, bm_copy, kernel, (clusters,))
+            if CHECKPOINT_FILE and step % CHECKPOINT_STEPS == 0:
+                state.update(step=step, rank=rank)
+                save_checkpoint(CHECKPOINT_FILE, state)
+
+        metrics["phase_1"] = phase_metrics(
+            start, first_rank - rank, first_rank - rank, kernel.size,
+            resyncs=nb_resyncs(first_step, step))
+        start = time.perf_counter()
+
+        # Phases II and III
+        state.update(phase=2, rank=nb_values, pm_copy=None, bm_copy=None)
+
+    rank = state["rank"]
+    (first_rank, first_step, searches) = (rank, step, 0)
+    if parallel_tiles(dither_map.shape, kernel) is not None:
+        rank = parallel_phase(pixels_map, blur_map, kernel, dither_map, rank,
+                              False)
+        searches = rank - first_rank
+    while rank < width*height:
+        if BATCH_SIZE > 1:
+            (rows, cols) = batch_voids(voids,
+                                       min(BATCH_SIZE, width*height - rank))
+            count = len(rows)
+            dither_map[rows, cols] = np.arange(rank, rank + count)
+            if LOGS: print("Phase 2: given #" + str(rank) + " to #"
+                + str(rank + count - 1) + " to a batch of voids")
+            set_pixels_np(pixels_map, blur_map, kernel, rows, cols, 1,
+                          (voids,))
+        else:
+            (i, j) = index_extremum_np(voids)
+            count = 1
+            dither_map[i, j] = rank
+            if LOGS: print("Phase 2: given #" + str(rank)
+                + " to (" + str(i) + ", " + str(j) + ")")
+            set_pixel_np(pixels_map, blur_map, kernel, i, j, 1, (voids,))
+        searches += 1
+        rank += count
+        step += count
+        if RESYNC_STEPS and step // RESYNC_STEPS > (step - count) // RESYNC_STEPS:
+            resync_np(pixels_map, blur_map, kernel, (voids,))
+        if (CHECKPOINT_FILE and
+                step // CHECKPOINT_STEPS > (step - count) // CHECKPOINT_STEPS):
+            state.update(step=step, rank=rank)
+            save_checkpoint(CHECKPOINT_FILE, state)
+
+    metrics["phase_2"] = phase_metrics(
+        start, rank - first_rank, searches, kernel.size,
+        resyncs=nb_resyncs(first_step, step))
+    # (the analysis makes several copies of the whole texture, so it is
+    # only done if the metrics are reported)
+    if BATCH_SIZE > 1 and (METRICS_CALLBACK is not None
+                           or METRICS_FILE is not None):
+        metrics["spectral_quality"] = spectral_quality(dither_map)
+    report_metrics(metrics)
+
+    if MMAP_DIR is not None:
+        dither_map.flush()
+    if CHECKPOINT_FILE and os.path.exists(CHECKPOINT_FILE):
+        os.remove(CHECKPOINT_FILE)
+    return dither_map
+
+
+def nb_resyncs(first_step, last_step):
+    """Number of resynchronisations of the blur maps done between the given
+       steps."""
+
+    if not RESYNC_STEPS:
+        return 0
+    return last_step // RESYNC_STEPS - first_step // RESYNC_STEPS
+
+
+def save_checkpoint(filename, state):
+    """Saves the state of run_phases_np in a .npz archive. The binary maps
+       are stored with one bit per pixel, the other maps in their own type.
+       The random generator is not used after the random pattern, so its
+       state is not saved. The file is written atomically, so that an
+       interruption during the save does not lose the previous
+       checkpoint."""
+
+    arrays = {"counters": np.array([state[name] for name in COUNTERS]),
+              "kernel": state["kernel"],
+              "dither_map": state["dither_map"]}
+    for name in ("blur_map", "bm_copy"):
+        if state.get(name) is not None:
+            arrays[name] = state[name]
+    for name in ("pixels_map", "pm_copy"):
+        if state.get(name) is not None:
+            arrays[name] = np.packbits(state[name].astype(bool))
+
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_checkpoint(filename):
+    """Loads a state saved by save_checkpoint. In memory-mapped mode, the
+       maps are copied in new mapped files."""
+
+    data = np.load(filename)
+    state = dict(zip(COUNTERS, (int(c) for c in data["counters"])))
+    state["kernel"] = data["kernel"]
+    (height, width) = data["dither_map"].shape
+
+    for (name, filename, dtype) in (
+            ("dither_map", "ranks", np.uint32),
+            ("pixels_map", "pixels", np.uint8),
+            ("blur_map", "blur", np.float32),
+            ("pm_copy", "pixels_copy", np.uint8),
+            ("bm_copy", "blur_copy", np.float32)):
+        if name not in data:
+            state[name] = None
+            continue
+        array = data[name]
+        if name in ("pixels_map", "pm_copy"):
+            array = np.unpackbits(array, count=height*width)
+            array = array.reshape(height, width).astype(bool)
+        if MMAP_DIR is None:
+            state[name] = array
+        else:
+            state[name] = mapped_array(filename, (height, width), dtype, 0)
+            state[name][:, :] = array
+    return state
+
+
+def mapped_array(name, shape, dtype, value):
+    """Creates the memory-mapped file name.npy in MMAP_DIR, filled with the
+       given value, and returns its mapping."""
+
+    array = np.lib.format.open_memmap(os.path.join(MMAP_DIR, name + ".npy"),
+                                      mode="w+", dtype=dtype, shape=shape)
+    for i in range(0, shape[0], chunk_rows(shape[1])):
+        array[i:i + chunk_rows(shape[1])] = value
+    return array
+
+
+def chunk_rows(width):
+    """Number of rows processed at once by the chunked operations on the
+       memory-mapped maps (about 4 million values)."""
+
+    return max(1, 2**22 // width)
+
+
+def make_kernel(sigma, blur_dist):
+    """Returns the gaussian weights used for the blur as a blur_dist x
+       blur_dist array. The element [0, 0] is the weight of the offset
+       (-blur_dist // 2, -blur_dist // 2), like the loops of update_map.
+       The kernel does not depend on the texture size, so it can be reused
+       for several textures."""
+
+    offsets = range(-blur_dist // 2, blur_dist // 2)
+    return np.array([[math.exp(- (ki**2 + kj**2) / (2 * sigma**2))
+                          for kj in offsets]
+                              for ki in offsets])
+
+
+def fit_kernel(kernel, width, height):
+    """Returns a view of the kernel with at most height x width offsets,
+       when the texture is smaller than the kernel."""
+
+    kh = min(height, kernel.shape[0])
+    kw = min(width, kernel.shape[1])
+    i0 = (-kh // 2) - (-kernel.shape[0] // 2)
+    j0 = (-kw // 2) - (-kernel.shape[1] // 2)
+    return kernel[i0:i0 + kh, j0:j0 + kw]
+
+
+def add_random_np(nb_values, pixels_map, blur_map, kernel, generator=random):
+    """Same as add_random for the NumPy engine. The random values are drawn
+       in the same order, to get the same pattern for the same seed.
+       If FFT_INIT is True, the blur map is computed once all the pixels are
+       added, with fft_blur."""
+
+    height, width = pixels_map.shape
+
+    for _ in range(nb_values):
+        i = generator.randrange(height)
+        j = generator.randrange(width)
+        while pixels_map[i, j]:
+            i = generator.randrange(height)
+            j = generator.randrange(width)
+        pixels_map[i, j] = True
+        if not FFT_INIT:
+            update_map_np(blur_map, kernel, i, j, 1)
+
+    if FFT_INIT:
+        blur_pattern(pixels_map, blur_map, kernel)
+
+
+def blur_pattern(pixels_map, blur_map, kernel):
+    """Computes the whole blur map from the pixels map, with fft_blur, or
+       with separable_blur in memory-mapped mode as the FFT needs several
+       full-size complex arrays."""
+
+    if MMAP_DIR is None:
+        blur_map[:, :] = fft_blur(pixels_map, kernel)
+    else:
+        separable_blur(pixels_map, blur_map, kernel)
+
+
+def fft_blur(pixels_map, kernel):
+    """Computes the blur map of a whole pixels map with a circular
+       convolution by the kernel, done with FFTs in O(N log N). The kernel
+       offsets are the same as in update_map_np."""
+
+    height, width = pixels_map.shape
+    kh, kw = kernel.shape
+
+    # Kernel laid on the torus, the offset (0, 0) being at position (0, 0)
+    psf = np.zeros((height, width))
+    psf[np.ix_((np.arange(kh) + (-kh // 2)) % height,
+               (np.arange(kw) + (-kw // 2)) % width)] = kernel
+
+    return np.fft.irfft2(np.fft.rfft2(pixels_map) * np.fft.rfft2(psf),
+                         s=(height, width))
+
+
+def separable_blur(pixels_map, blur_map, kernel):
+    """Computes the blur map of a whole pixels map by chunks, as two 1d
+       circular convolutions, as the gaussian kernel is the product of a
+       column and a row. The intermediate map is kept in a temporary
+       memory-mapped file."""
+
+    height, width = pixels_map.shape
+    kh, kw = kernel.shape
+    column = kernel[:, 0] / kernel[0, 0]
+    row = kernel[0, :]
+
+    tmp_filename = os.path.join(MMAP_DIR, "blur_tmp.npy")
+    tmp = np.lib.format.open_memmap(tmp_filename, mode="w+",
+                                    dtype=blur_map.dtype, shape=(height, width))
+
+    # Horizontal convolution, by chunks of rows
+    step = chunk_rows(width)
+    for i in range(0, height, step):
+        chunk = np.asarray(pixels_map[i:i + step], dtype=np.float64)
+        acc = np.zeros_like(chunk)
+        for kj in range(kw):
+            acc += row[kj] * np.roll(chunk, kj + (-kw // 2), axis=1)
+        tmp[i:i + step] = acc
+
+    # Vertical convolution, by chunks of columns
+    step = chunk_rows(height)
+    for j in range(0, width, step):
+        chunk = np.asarray(tmp[:, j:j + step], dtype=np.float64)
+        acc = np.zeros_like(chunk)
+        for ki in range(kh):
+            acc += column[ki] * np.roll(chunk, ki + (-kh // 2), axis=0)
+        blur_map[:, j:j + step] = acc
+
+    del tmp
+    os.remove(tmp_filename)
+
+
+def resync_np(pixels_map, blur_map, kernel, indexes):
+    """Recomputes the blur map from the pixels map with blur_pattern, and
+       rebuilds the given indexes."""
+
+    blur_pattern(pixels_map, blur_map, kernel)
+    for index in indexes:
+        refresh_index_np(index, pixels_map, blur_map)
+
+
+def update_map_np(blur_map, kernel, i, j, value):
+    """Adds (value=1) or removes (value=-1) the kernel centered on (i, j)
+       in the blur map, with periodic wrap. The kernel is added with at most
+       four slice additions."""
+
+    height, width = blur_map.shape
+    kh, kw = kernel.shape
+
+    for (rows, krows) in wrapped_slices(i + (-kh // 2), kh, height):
+        for (cols, kcols) in wrapped_slices(j + (-kw // 2), kw, width):
+            blur_map[rows, cols] += value * kernel[krows, kcols]
+
+
+def set_pixel_np(pixels_map, blur_map, kernel, i, j, value, indexes):
+    """Adds (value=1) or removes (value=-1) the pixel (i, j), and refreshes
+       the tiles of the given indexes covered by the modified window."""
+
+    pixels_map[i, j] = value > 0
+    update_map_np(blur_map, kernel, i, j, value)
+
+    height, width = blur_map.shape
+    kh, kw = kernel.shape
+    for index in indexes:
+        tile = index["tile"]
+        for (rows, _) in wrapped_slices(i + (-kh // 2), kh, height):
+            for (cols, _) in wrapped_slices(j + (-kw // 2), kw, width):
+                refresh_tiles_np(index, pixels_map, blur_map,
+                                 rows.start // tile, (rows.stop - 1) // tile + 1,
+                                 cols.start // tile, (cols.stop - 1) // tile + 1)
+        # The window of a kernel of size 1 does not contain (i, j) itself
+        refresh_tiles_np(index, pixels_map, blur_map, i // tile,
+                         i // tile + 1, j // tile, j // tile + 1)
+
+
+def set_pixels_np(pixels_map, blur_map, kernel, rows, cols, value, indexes):
+    """Same as set_pixel_np for the pixels (rows[k], cols[k]), with one
+       addition of all their kernels and one refresh of all the tiles they
+       cover."""
+
+    height, width = blur_map.shape
+    kh, kw = kernel.shape
+    pixels_map[rows, cols] = value > 0
+
+    krows = (rows[:, None, None] + np.arange(kh)[None, :, None]
+             + (-kh // 2)) % height
+    kcols = (cols[:, None, None] + np.arange(kw)[None, None, :]
+             + (-kw // 2)) % width
+    weights = np.broadcast_to(value * kernel, krows.shape[:1] + kernel.shape)
+    np.add.at(blur_map.reshape(-1), (krows * width + kcols).ravel(),
+              weights.ravel().astype(blur_map.dtype))
+
+    for index in indexes:
+        tile = index["tile"]
+        touched = np.zeros(index["values"].shape, dtype=bool)
+        touched[krows // tile, kcols // tile] = True
+        touched[rows // tile, cols // tile] = True
+        tiles = np.flatnonzero(touched)
+        if 2 * len(tiles) > touched.size:
+            refresh_index_np(index, pixels_map, blur_map)
+        else:
+            refresh_tile_list_np(index, pixels_map, blur_map, tiles)
+
+
+def batch_voids(index, count):
+    """Returns the positions (as arrays of rows and columns) of at most
+       count voids to insert together: the largest voids of the tiles, by
+       decreasing size, skipping the ones closer than BATCH_MIN_DIST (on the
+       torus) to a void already chosen. The first one is always the largest
+       void of the map."""
+
+    values = index["values"].ravel()
+    args = index["args"].ravel()
+    height = index["height"]
+    width = index["width"]
+
+    # Candidates, by decreasing size
+    order = np.lexsort((args, -values))
+    order = order[values[order] > -np.inf][:2 * count]
+    if len(order) == 0:
+        order = np.lexsort((args, -values))[:1]
+    (rows, cols) = np.divmod(args[order], width)
+
+    # The chosen voids are sorted in cells of at least BATCH_MIN_DIST pixels,
+    # so that only the neighbouring cells have to be checked
+    nci = max(1, height // max(BATCH_MIN_DIST, 1))
+    ncj = max(1, width // max(BATCH_MIN_DIST, 1))
+    cells = {}
+    chosen = []
+    for (k, (i, j)) in enumerate(zip(rows.tolist(), cols.tolist())):
+        (ci, cj) = (i * nci // height, j * ncj // width)
+        if not any(torus_dist2(i, j, i2, j2, height, width) < BATCH_MIN_DIST**2
+                   for a in (-1, 0, 1) for b in (-1, 0, 1)
+                   for (i2, j2) in cells.get(((ci + a) % nci, (cj + b) % ncj),
+                                             ())):
+            cells.setdefault((ci, cj), []).append((i, j))
+            chosen.append(k)
+            if len(chosen) == count:
+                break
+
+    return rows[chosen], cols[chosen]
+
+
+def torus_dist2(i1, j1, i2, j2, height, width):
+    """Returns the squared distance between two pixels on the torus."""
+
+    di = abs(i1 - i2)
+    dj = abs(j1 - j2)
+    return min(di, height - di)**2 + min(dj, width - dj)**2
+
+
+def spectral_quality(dither_map, levels=(0.1, 0.25, 0.5, 0.75, 0.9)):
+    """Measures the quality of a blue noise texture: for each level, the
+       pattern of the pixels with a rank below level * N is made and the
+       mean of its power spectrum at low frequencies (below half of the
+       principal frequency) is divided by the mean of the whole spectrum.
+       This ratio is about 1 for white noise and 0 for an ideal blue noise.
+       Returns the mean ratio over the levels (cf noise_analysis)."""
+
+    return noise_analysis.analyze_2d(dither_map, levels)["low_frequency"]
+
+
+def parallel_tiles(shape, kernel):
+    """Returns the bounds of the rows and of the columns of the tiles used by
+       parallel_phase for maps of the given shape, or None if the phases are
+       not parallel. There is an even number of tiles per axis, so that the
+       4 groups alternate on the torus, and the tiles are not smaller than
+       the kernel, so that the windows of two tiles of the same group never
+       overlap."""
+
+    if not PARALLEL_TILES or MMAP_DIR is not None:
+        return None
+
+    bounds = []
+    for (size, ksize) in zip(shape, kernel.shape):
+        nb_tiles = size // max(ksize, PARALLEL_TILE) // 2 * 2
+        if nb_tiles < 2:
+            return None
+        bounds.append([k * size // nb_tiles for k in range(nb_tiles + 1)])
+    return bounds
+
+
+def parallel_phase(pixels_map, blur_map, kernel, dither_map, rank, ones):
+    """Runs Phase I (ones=True) or Phases II and III (ones=False) with a
+       pool of WORKERS processes (or in the main process if WORKERS is 1),
+       from the given rank, and returns the rank reached. The maps are
+       copied in shared memory during the phase. The ranks are given in a
+       fixed order (by step, then by group, then by tile), so the result
+       does not depend on the scheduling."""
+
+    (height, width) = pixels_map.shape
+    (row_bounds, col_bounds) = parallel_tiles(pixels_map.shape, kernel)
+    shared_pixels = multiprocessing.RawArray('B', height * width)
+    shared_blur = multiprocessing.RawArray('d', height * width)
+    maps = shared_maps(shared_pixels, shared_blur, (height, width))
+    maps[0][...] = pixels_map
+    maps[1][...] = blur_map
+
+    groups = [[(ti, tj, ones)
+               for ti in range(len(row_bounds) - 1)
+               for tj in range(len(col_bounds) - 1)
+               if (ti % 2, tj % 2) == group]
+              for group in ((0, 0), (0, 1), (1, 0), (1, 1))]
+    remaining = int(np.count_nonzero(maps[0]))
+    if not ones:
+        remaining = height * width - remaining
+
+    initargs = (shared_pixels, shared_blur, (height, width), kernel,
+                row_bounds, col_bounds)
+    if WORKERS <= 1:
+        init_parallel_worker(*initargs)
+        pool = contextlib.nullcontext()
+        tile_map = lambda function, tasks: list(map(function, tasks))
+    else:
+        pool = multiprocessing.Pool(WORKERS, init_parallel_worker, initargs)
+        tile_map = pool.map
+
+    with pool:
+        while remaining > 0:
+            # The groups must be processed one after the other
+            results = [tile_map(parallel_tile_steps, group)
+                       for group in groups]
+            for step in range(PARALLEL_STEPS):
+                for group_results in results:
+                    for pixels in group_results:
+                        if step < len(pixels):
+                            dither_map[pixels[step]] = rank
+                            rank += -1 if ones else 1
+                            remaining -= 1
+            if LOGS: print("Phase " + ("1" if ones else "2")
+                + ": given ranks up to #" + str(rank))
+
+    parallel_state.clear()
+    pixels_map[...] = maps[0]
+    blur_map[...] = maps[1]
+    return rank
+
+
+def shared_maps(shared_pixels, shared_blur, shape):
+    """Returns the pixels map and the blur map of parallel_phase as arrays
+       viewing the shared memory."""
+
+    return (np.frombuffer(shared_pixels, dtype=np.uint8).reshape(shape),
+            np.frombuffer(shared_blur, dtype=np.float64).reshape(shape))
+
+
+# State of the processes of parallel_phase (cf init_parallel_worker)
+parallel_state = {}
+
+
+def init_parallel_worker(shared_pixels, shared_blur, shape, kernel,
+                         row_bounds, col_bounds):
+    """Initializes a process of the pool of parallel_phase."""
+
+    parallel_state["maps"] = shared_maps(shared_pixels, shared_blur, shape)
+    parallel_state["kernel"] = kernel
+    parallel_state["bounds"] = (row_bounds, col_bounds)
+
+
+def parallel_tile_steps(task):
+    """Removes the PARALLEL_STEPS tightest clusters (ones=True) or fills the
+       PARALLEL_STEPS largest voids (ones=False) of the tile (ti, tj), one at
+       a time, and returns their positions. Only the pixels of the tile are
+       read, and only the tile and its halo are modified."""
+
+    (ti, tj, ones) = task
+    (pixels_map, blur_map) = parallel_state["maps"]
+    kernel = parallel_state["kernel"]
+    (row_bounds, col_bounds) = parallel_state["bounds"]
+    (i0, i1) = (row_bounds[ti], row_bounds[ti + 1])
+    (j0, j1) = (col_bounds[tj], col_bounds[tj + 1])
+    tile_pixels = pixels_map[i0:i1, j0:j1]
+    tile_blur = blur_map[i0:i1, j0:j1]
+
+    pixels = []
+    for _ in range(PARALLEL_STEPS):
+        if ones:
+            keys = np.where(tile_pixels, tile_blur, -np.inf)
+            k = int(np.argmax(keys))
+        else:
+            keys = np.where(tile_pixels, np.inf, tile_blur)
+            k = int(np.argmin(keys))
+        if np.isinf(keys.flat[k]):
+            break
+        (i, j) = (i0 + k // (j1 - j0), j0 + k % (j1 - j0))
+        pixels_map[i, j] = not ones
+        update_map_np(blur_map, kernel, i, j, -1 if ones else 1)
+        pixels.append((i, j))
+    return pixels
+
+
+def refresh_tile_list_np(index, pixels_map, blur_map, tiles):
+    """Same as refresh_tiles_np for a list of tiles, given by their numbers
+       in reading order."""
+
+    tile = index["tile"]
+    height, width = blur_map.shape
+    (ti, tj) = np.divmod(tiles, index["values"].shape[1])
+    rows = ti[:, None, None] * tile + np.arange(tile)[None, :, None]
+    cols = tj[:, None, None] * tile + np.arange(tile)[None, None, :]
+    outside = (rows >= height) | (cols >= width)
+    if outside.any():
+        rows = np.minimum(rows, height - 1)
+        cols = np.minimum(cols, width - 1)
+
+    pixels = pixels_map[rows, cols]
+    if index["ones"]:
+        keys = np.where(pixels, blur_map[rows, cols], -np.inf)
+    else:
+        keys = np.where(pixels, -np.inf, -blur_map[rows, cols])
+    keys[outside] = -np.inf
+    keys = keys.reshape(len(tiles), tile * tile)
+
+    k = keys.argmax(axis=1)
+    index["values"].ravel()[tiles] = keys.max(axis=1)
+    index["args"].ravel()[tiles] = (index["origins"].ravel()[tiles]
+                                    + index["offsets"][k])
+    refresh_rows_np(index, np.unique(ti))
+
+
+def build_index_np(pixels_map, blur_map, ones, tile=None):
+    """Builds an extremum index of the pixels equal to ones: the map is cut
+       in tiles of tile x tile pixels (TILE_SIZE by default) and for each of
+       them the index stores the value and the position of its tightest
+       cluster (ones=True) or largest void (ones=False). Voids are stored
+       with negated values, so that both kinds of index look for a maximum.
+       The index also stores the best value of each row of tiles and its
+       first position.
+       As update_map only modifies a window of the size of the kernel, only
+       the few tiles covered by this window and their rows have to be
+       recomputed, and the search is done on the rows of tiles instead of
+       the pixels."""
+
+    if tile is None:
+        tile = TILE_SIZE
+    height, width = pixels_map.shape
+    nti = (height + tile - 1) // tile
+    ntj = (width + tile - 1) // tile
+    index = {"ones": ones,
+             "tile": tile,
+             "width": width,
+             "height": height,
+             "values": np.empty((nti, ntj), dtype=blur_map.dtype),
+             "args": np.empty((nti, ntj), dtype=np.int64),
+             "row_values": np.empty(nti, dtype=blur_map.dtype),
+             "row_args": np.empty(nti, dtype=np.int64),
+             # Position of the first pixel of each tile, and position of
+             # each pixel of a tile relatively to the first one
+             "origins": tile * (np.arange(nti)[:, None] * width
+                                + np.arange(ntj)[None, :]),
+             "offsets": (np.arange(tile * tile) // tile * width
+                         + np.arange(tile * tile) % tile)}
+    refresh_index_np(index, pixels_map, blur_map)
+    return index
+
+
+def refresh_index_np(index, pixels_map, blur_map):
+    """Recomputes all the tiles of an index, by bands of tile rows of about
+       chunk_rows(width) rows, like separable_blur, so that the copies made
+       by refresh_tiles_np stay small with the memory-mapped maps."""
+
+    (nti, ntj) = index["values"].shape
+    step = max(1, chunk_rows(pixels_map.shape[1]) // index["tile"])
+    for ti in range(0, nti, step):
+        refresh_tiles_np(index, pixels_map, blur_map, ti, min(ti + step, nti),
+                         0, ntj)
+
+
+def refresh_tiles_np(index, pixels_map, blur_map, ti0, ti1, tj0, tj1):
+    """Recomputes the tiles [ti0, ti1) x [tj0, tj1) of an index."""
+
+    tile = index["tile"]
+    height, width = blur_map.shape
+    (i0, i1) = (ti0 * tile, min(ti1 * tile, height))
+    (j0, j1) = (tj0 * tile, min(tj1 * tile, width))
+    (nti, ntj) = (ti1 - ti0, tj1 - tj0)
+
+    if index["ones"]:
+        keys = np.where(pixels_map[i0:i1, j0:j1], blur_map[i0:i1, j0:j1],
+                        -np.inf)
+    else:
+        keys = np.where(pixels_map[i0:i1, j0:j1], -np.inf,
+                        -blur_map[i0:i1, j0:j1])
+    if keys.shape != (nti * tile, ntj * tile):
+        padded = np.full((nti * tile, ntj * tile), -np.inf, dtype=keys.dtype)
+        padded[:i1 - i0, :j1 - j0] = keys
+        keys = padded
+
+    # The pixels of each tile are in reading order, so argmax gives the
+    # first of them in case of equality
+    blocks = keys.reshape(nti, tile, ntj, tile).swapaxes(1, 2)
+    blocks = blocks.reshape(nti, ntj, tile * tile)
+    k = blocks.argmax(axis=2)
+    index["values"][ti0:ti1, tj0:tj1] = blocks.max(axis=2)
+    index["args"][ti0:ti1, tj0:tj1] = (index["origins"][ti0:ti1, tj0:tj1]
+                                       + index["offsets"][k])
+    refresh_rows_np(index, slice(ti0, ti1))
+
+
+def refresh_rows_np(index, rows):
+    """Recomputes the best value and its first position of the given rows of
+       tiles of an index (a slice or an array of numbers of rows)."""
+
+    values = index["values"][rows]
+    best = values.max(axis=1)
+    args = np.where(values == best[:, None], index["args"][rows],
+                    np.iinfo(np.int64).max)
+    index["row_values"][rows] = best
+    index["row_args"][rows] = args.min(axis=1)
+
+
+def index_extremum_np(index):
+    """Finds the tightest cluster or the largest void with the given index.
+       In case of equality, the first pixel in reading order is taken, like
+       in index_extremum."""
+
+    values = index["row_values"]
+    best = values.max()
+    k = int(index["row_args"][values == best].min())
+    return divmod(k, index["width"])
+
+
+def wrapped_slices(start, size, length):
+    """Splits the periodic range [start, start + size) of an axis of the
+       given length in at most two (map slice, kernel slice) pairs."""
+
+    start %= length
+    if start + size <= length:
+        return [(slice(start, start + size), slice(0, size))]
+    cut = length - start
+    return [(slice(start, length), slice(0, cut)),
+            (slice(0, size - cut), slice(cut, size))]
+
+
+def save_texture(matrix, filename):
+    """Saves the ranks in a binary file if the filename has the extension
+       of a binary format of noise_io, else in a PNG image."""
 
-    for ki in range(-min(height, blur_dist) // 2, min(height, blur_dist) // 2):
-        for kj in range(-min(width, blur_dist) // 2, min(width, blur_dist) // 2):
-            blur_map[(i + ki) % height][(j + kj) % width] += (
-                value * gauss[ki**2 + kj**2] )
+    if noise_io.is_binary(filename):
+        noise_io.save(filename, np.asarray(matrix, dtype=np.uint32))
+    else:
+        save_image(matrix, filename)
 
 
 def save_image(matrix, filename):
-    """Saves the given matrix in a greyscale image with the given filename."""
+    """Saves the given matrix in a greyscale image with the given filename,
+       or in an image with one channel per texture if the matrix has a third
+       dimension (2 channels: grey and alpha, 3: RGB, 4: RGBA).
+       The values are the ranks 0 to width*height - 1, so the maximum is
+       known and the rows can be rescaled and written one at a time."""
 
-    max_mat = max(matrix[i][j]
-                      for i in range(len(matrix))
-                          for j in range(len(matrix[0])))
+    height = len(matrix)
+    width = len(matrix[0])
+    channels = np.shape(matrix[0])[1] if np.ndim(matrix[0]) > 1 else 1
+    if channels > 4:
+        raise ValueError("A PNG image can only have 4 channels")
+    max_mat = max(width*height - 1, 1)
 
-    matrix = [[(65535 * matrix[i][j]) // max_mat
-                   for j in range(len(matrix[i]))]
-                       for i in range(len(matrix))]
+    rows = ((np.asarray(matrix[i], dtype=np.uint64) * 65535 // max_mat)
+                .astype(np.uint16).ravel()
+                    for i in range(height))
 
-    png.from_array(matrix, "L;16").save(filename)
+    writer = png.Writer(width, height, greyscale=channels < 3,
+                        alpha=channels in (2, 4), bitdepth=16)
+    with open(filename, "wb") as f:
+        writer.write(f, rows)
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
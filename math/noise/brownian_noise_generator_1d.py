@@ -6,8 +6,9 @@
 #                                                                            #
 ##############################################################################
 
-# This program generates a 1d blue-noise file, and saves it in a csv file.
-# The values are between 0 and s-1 where s is the size of a row.
+# This program generates a 1d blue-noise file, and saves it in a csv file,
+# or in a .npy or .noise file (cf noise_io) if the filename has one of these
+# extensions. The values are between 0 and s-1 where s is the size of a row.
 
 # HOWTO: just run the program and it will request the needed parameters.
 
@@ -15,21 +16,240 @@
 
 
 import random
+import numpy as np
+import noise_io
+import noise_rng
+
+
+# Seed of the random generators, to get reproducible files (None for a random
+# seed). Each row is computed from its own random generator, the stream
+# ("row", number of the row) of the seed (cf noise_rng).
+SEED = None
+
+# Engine used to compute the rows: "smoother" is the original one, averaging
+# each value of a white noise with the next one. "spectral" computes a real
+# 1/f^ALPHA noise by shaping the spectrum of a white noise with a FFT (cf
+# colored_noise): ALPHA = 2 gives brownian noise, 1 pink noise, 0 white noise
+# and negative values blue noise. "stream" computes each row by chunks of
+# STREAM_CHUNK values with the filter FILTER (cf stream_noise), so the memory
+# used does not depend on the length of the rows.
+ENGINE = "smoother"
+ALPHA = 2
+
+# Filter of the "stream" engine, applied periodically to a white noise w of
+# n values:
+#  - ("fir", taps): the value i is sum(taps[k] * w[(i + k) % n]) / sum(taps),
+#    ("fir", (0.5, 0.5)) being the filter of the original smoother.
+#  - ("iir", a): the value i is a * y[i - 1] + (1 - a) * w[i], y[-1] being
+#    the last value of the row (0 <= a < 1).
+FILTER = ("fir", (0.5, 0.5))
+STREAM_CHUNK = 2**16
+
+# Size of the blocks in which the "iir" filter is computed with products of
+# matrices (cf recurrence)
+IIR_BLOCK = 64
+
+# Maximum number of values computed at once by the spectral engine: the rows
+# are computed by chunks of rows of at most CHUNK_VALUES values (or one row
+# at a time if they are longer). A single row is never split, since the FFT
+# needs the whole row: a row longer than CHUNK_VALUES is computed whole, so
+# use ENGINE = "stream" for rows which do not fit in memory.
+CHUNK_VALUES = 2**22
 
 
 def main():
     out_filename = input("Filename: ")
     nb_rows = int(input("Number of rows: "))
     nb_values = int(input("Values per row: "))
+    seed = SEED if SEED is not None else noise_rng.new_seed()
+
+    if noise_io.is_binary(out_filename):
+        table = noise_io.create(out_filename, (nb_rows, nb_values), np.uint32)
+        for (i, chunks) in enumerate(generate_row_chunks(nb_rows, nb_values,
+                                                         seed)):
+            position = 0
+            for chunk in chunks:
+                table[i, position:position + len(chunk)] = chunk
+                position += len(chunk)
+        table.flush()
+    else:
+        with open(out_filename, 'w') as f:
+            for chunks in generate_row_chunks(nb_rows, nb_values, seed):
+                # Each chunk is written on its own, so that a row is never
+                # entirely in memory
+                separator = ""
+                for chunk in chunks:
+                    if len(chunk):
+                        f.write(separator + ";".join(map(str, chunk)))
+                        separator = ";"
+                f.write("\n")
+
+
+def generate_row_chunks(nb_rows, nb_values, seed):
+    """Like generate_rows, but yields each row as an iterable of chunks of
+       values, so that the rows of the "stream" engine are never entirely in
+       memory."""
+
+    if ENGINE == "stream":
+        for row in range(nb_rows):
+            yield stream_noise(nb_values, FILTER, seed, row)
+    else:
+        for row in generate_rows(nb_rows, nb_values, seed):
+            yield (row,)
+
+
+def generate_rows(nb_rows, nb_values, seed):
+    """Generates nb_rows rows of nb_values values with the engine selected by
+       ENGINE and the given seed, and yields them one at a time."""
+
+    if ENGINE == "stream":
+        for row in range(nb_rows):
+            yield np.concatenate(list(stream_noise(nb_values, FILTER, seed,
+                                                   row))).tolist()
+    elif ENGINE == "spectral":
+        chunk = max(1, CHUNK_VALUES // nb_values)
+        for first in range(0, nb_rows, chunk):
+            count = min(chunk, nb_rows - first)
+            generators = [noise_rng.numpy_stream(seed, "row", row)
+                          for row in range(first, first + count)]
+            yield from colored_noise(count, nb_values, ALPHA,
+                                     generators).tolist()
+    else:
+        for row in range(nb_rows):
+            yield brownian_noise(nb_values,
+                                 noise_rng.stream(seed, "row", row))
+
+
+def brownian_noise(nb_values, generator=random):
+    """Generates a row of nb_values values between 0 and nb_values - 1, by
+       smoothing white noise drawn from the given random generator."""
+
+    white = [generator.uniform(0, nb_values-1) for i in range(nb_values)]
+    return smoother(white)
+
+
+def colored_noise(nb_rows, nb_values, alpha, generators=None):
+    """Generates nb_rows rows of 1/f^alpha noise of nb_values values between
+       0 and nb_values - 1, as an array: the spectrum of a gaussian white
+       noise is multiplied by f^(-alpha/2) (so that the power is multiplied by
+       f^-alpha), without its constant term, and transformed back. All the
+       rows are transformed at once, in O(n log n). The rows are periodic,
+       like the ones of brownian_noise. The white noise of each row is drawn
+       from the given NumPy generators (one per row), by default from one
+       generator seeded with the random module."""
+
+    if generators is None:
+        generator = np.random.default_rng(random.getrandbits(128))
+        white = generator.standard_normal((nb_rows, nb_values))
+    else:
+        white = np.array([generator.standard_normal(nb_values)
+                          for generator in generators]).reshape(nb_rows,
+                                                                nb_values)
+
+    frequencies = np.fft.rfftfreq(nb_values)
+    gains = np.zeros_like(frequencies)
+    gains[1:] = frequencies[1:] ** (-alpha / 2)
+    noise = np.fft.irfft(np.fft.rfft(white, axis=1) * gains, nb_values, axis=1)
+
+    # Rescaling of each row to [0, nb_values - 1]
+    low = noise.min(axis=1, keepdims=True)
+    high = noise.max(axis=1, keepdims=True)
+    noise -= low
+    noise *= (nb_values - 1) / np.maximum(high - low, np.finfo(float).tiny)
+    return noise.astype(np.int64)
+
+
+def stream_noise(nb_values, noise_filter, seed, row):
+    """Generates the given row of nb_values values between 0 and
+       nb_values - 1 by filtering a white noise periodically (cf FILTER), and
+       yields it by chunks of STREAM_CHUNK values. The white noise is
+       generated by chunks too, from the stream of the row (cf noise_rng), so
+       that it can be generated again when the filter needs two passes."""
+
+    def white():
+        generator = noise_rng.numpy_stream(seed, "row", row)
+        for start in range(0, nb_values, STREAM_CHUNK):
+            yield generator.uniform(0, nb_values - 1,
+                                    min(STREAM_CHUNK, nb_values - start))
+
+    (kind, parameter) = noise_filter
+    if kind == "fir":
+        chunks = fir_stream(white(), np.asarray(parameter, dtype=float))
+    else:
+        chunks = iir_stream(white, parameter, nb_values)
+    for chunk in chunks:
+        yield np.clip(chunk, 0, nb_values - 1).astype(np.int64)
+
+
+def fir_stream(chunks, taps):
+    """Applies a FIR filter (cf FILTER) to a periodic signal given by chunks,
+       and yields the filtered chunks. The last len(taps) - 1 values of each
+       chunk are kept to compute the next one, and the first ones of the
+       signal are kept to compute the end of the signal, which wraps
+       around."""
+
+    taps = taps / taps.sum()
+    lookahead = len(taps) - 1
+    head = np.empty(0)
+    buffer = np.empty(0)
+
+    def apply(buffer):
+        count = len(buffer) - lookahead
+        return sum(taps[k] * buffer[k:k + count] for k in range(len(taps)))
+
+    for chunk in chunks:
+        if len(head) < lookahead:
+            head = np.concatenate((head, chunk[:lookahead - len(head)]))
+        buffer = np.concatenate((buffer, chunk))
+        if len(buffer) > lookahead:
+            yield apply(buffer)
+            buffer = buffer[len(buffer) - lookahead:]
+
+    # Wrap-around (the signal can be shorter than the filter)
+    yield apply(np.concatenate((buffer, np.resize(head, lookahead))))
+
+
+def iir_stream(white, a, nb_values):
+    """Applies a IIR filter (cf FILTER) to a periodic signal of nb_values
+       values, given by the function white which returns a new iterator on
+       its chunks, and yields the filtered chunks. A first pass computes the
+       last value of the signal filtered from 0, from which the last value y
+       of the periodic solution is deduced (the influence of y on the value
+       i being a^(i+1) * y), then a second pass computes the signal from
+       y."""
+
+    y = 0.0
+    for chunk in white():
+        y = recurrence((1 - a) * chunk, a, y)[-1]
+    y /= 1 - a ** nb_values
+
+    for chunk in white():
+        chunk = recurrence((1 - a) * chunk, a, y)
+        y = chunk[-1]
+        yield chunk
+
+
+def recurrence(x, a, y):
+    """Returns the values y[i] = a * y[i - 1] + x[i], from the given y[-1].
+       The values are computed by blocks of IIR_BLOCK values with a product
+       of matrices, the values at the end of the blocks being given by the
+       same recurrence with the coefficient a^IIR_BLOCK."""
 
-    file_content = ""
-    for i in range(nb_rows):
-	    white = [random.uniform(0, nb_values-1) for i in range(nb_values)]
-	    brownian = smoother(white)
-	    file_content += ";".join(map(str, brownian)) + "\n"
+    size = len(x)
+    block = min(IIR_BLOCK, size)
+    powers = a ** np.arange(block + 1)
+    offsets = np.subtract.outer(np.arange(block), np.arange(block))
+    matrix = np.where(offsets >= 0, powers[np.abs(offsets)], 0)
 
-    with open(out_filename, 'w') as f:
-        f.write(file_content)
+    blocks = np.zeros(-(-size // block) * block)
+    blocks[:size] = x
+    blocks = blocks.reshape(-1, block) @ matrix.T
+    if len(blocks) == 1:
+        starts = np.array([y])
+    else:
+        ends = recurrence(blocks[:, -1], powers[block], y)
+        starts = np.concatenate(([y], ends[:-1]))
+    return (blocks + np.outer(starts, powers[1:])).ravel()[:size]
 
 
 def smoother(noise):
@@ -39,4 +259,5 @@ def smoother(noise):
     return output
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+##############################################################################
+#                                                                            #
+#  Written in 2017 by Louis Sugy                                             #
+#                                                                            #
+#  License : CC-BY                                                           #
+#                                                                            #
+##############################################################################
+
+# This program checks the quality of noise files: the 2d textures of
+# blue_noise_generator_2d (PNG images or binary tables, with one or several
+# channels) and the rows of the 1d generators (csv files or binary tables).
+
+# HOWTO: python3 noise_analysis.py [--json results.json] file [file...]
+# For each texture (each channel of a 2d file, or all the rows of a 1d file),
+# the program prints its scores and whether it passes, and exits with an
+# error code if one of them fails. With --json, the full analyses (including
+# the radially averaged power spectra) are saved in results.json.
+
+# For each threshold level, the binary pattern of the values below
+# level * (maximum + 1) is made, and its power spectrum is computed (all the
+# levels at once, with one batched FFT). The spectrum is averaged over rings
+# of frequencies (or over the rows in 1d), and two scores are derived:
+#  - the low-frequency ratio: the mean power at the frequencies below half of
+#    the principal frequency of the pattern, divided by the mean power. It is
+#    about 1 for white noise and 0 for an ideal blue noise.
+#  - the anisotropy (2d only): the variance of the power in each ring
+#    divided by its squared mean, in dB, averaged over the rings. It is about
+#    0 dB for an isotropic noise, and higher when some directions dominate.
+
+# PNG images and tables with channels are always read as 2d textures. Other
+# tables (csv files or binary tables) are read as rows of 1d noise if their
+# values are lower than the length of their rows (the values of a row are
+# then 0 to n - 1), else as 2d textures.
+
+
+import json
+import math
+import os
+import sys
+import numpy as np
+import noise_io
+
+
+# Threshold levels of the patterns
+LEVELS = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+# Number of rings (or bands of frequencies in 1d) of the radially averaged
+# power spectra
+RADIAL_BINS = 32
+
+# A texture passes if its low-frequency ratio and its anisotropy are at most
+MAX_LOW_FREQUENCY = 0.3
+MAX_ANISOTROPY = 2.0
+
+
+def main():
+    args = sys.argv[1:]
+    json_filename = None
+    if len(args) > 1 and args[0] == "--json":
+        json_filename = args[1]
+        args = args[2:]
+
+    results = {}
+    passed = True
+    for filename in args:
+        for (name, analysis) in analyze_file(filename):
+            print_analysis(name, analysis)
+            results[name] = analysis
+            passed = passed and analysis["passed"]
+
+    if json_filename is not None:
+        with open(json_filename, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not passed:
+        sys.exit(1)
+
+
+def analyze_file(filename):
+    """Analyzes the noise of a file, and returns a list of (name, analysis)
+       pairs: one per channel for a 2d texture, one for rows of 1d noise."""
+
+    table = np.asarray(noise_io.load(filename))
+    is_png = os.path.splitext(filename)[1].lower() == ".png"
+    if table.ndim == 2 and not is_png and table.max() < table.shape[1]:
+        return [(filename, analyze_1d(table))]
+    if table.ndim == 2:
+        return [(filename, analyze_2d(table))]
+    return [(filename + " [channel " + str(c) + "]",
+             analyze_2d(table[:, :, c]))
+            for c in range(table.shape[2])]
+
+
+def analyze_2d(texture, levels=LEVELS):
+    """Analyzes a 2d texture (cf the header of this file) and returns a dict
+       with the scores and the spectra of each level, the mean scores and
+       whether the texture passes."""
+
+    texture = np.asarray(texture)
+    height, width = texture.shape
+    top = float(texture.max()) + 1
+
+    patterns = np.stack([texture < level * top for level in levels])
+    patterns = patterns.astype(np.float64)
+    patterns -= patterns.mean(axis=(1, 2), keepdims=True)
+    spectra = (np.abs(np.fft.rfft2(patterns))**2).reshape(len(levels), -1)
+
+    fi = np.fft.fftfreq(height)[:, None]
+    fj = np.fft.rfftfreq(width)[None, :]
+    radius = np.sqrt(fi**2 + fj**2).ravel()
+    (means, anisotropies) = radial_average(spectra, radius)
+
+    principals = [math.sqrt(min(level, 1 - level)) for level in levels]
+    return summarize(levels, spectra, radius, principals, means,
+                     anisotropies)
+
+
+def analyze_1d(rows, levels=LEVELS):
+    """Analyzes rows of 1d noise (cf the header of this file), like
+       analyze_2d. The spectra are averaged over the rows, and there is no
+       anisotropy."""
+
+    rows = np.asarray(rows)
+    top = float(rows.max()) + 1
+
+    patterns = np.stack([rows < level * top for level in levels])
+    patterns = patterns.astype(np.float64)
+    patterns -= patterns.mean(axis=2, keepdims=True)
+    spectra = (np.abs(np.fft.rfft(patterns))**2).mean(axis=1)
+
+    radius = np.fft.rfftfreq(rows.shape[1])
+    (means, _) = radial_average(spectra, radius)
+
+    principals = [min(level, 1 - level) for level in levels]
+    return summarize(levels, spectra, radius, principals, means, None)
+
+
+def radial_average(spectra, radius):
+    """Averages the power spectra (one per row) over RADIAL_BINS rings of
+       frequencies. Returns the means and the anisotropies (in dB) of the
+       rings, NaN for the empty ones."""
+
+    bins = np.minimum((radius / max(radius.max(), 1e-12)
+                       * RADIAL_BINS).astype(int), RADIAL_BINS - 1)
+    counts = np.bincount(bins, minlength=RADIAL_BINS)
+    sums = np.array([np.bincount(bins, spectrum, RADIAL_BINS)
+                     for spectrum in spectra])
+    squares = np.array([np.bincount(bins, spectrum**2, RADIAL_BINS)
+                        for spectrum in spectra])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums / counts
+        variances = squares / counts - means**2
+        anisotropies = 10 * np.log10(variances / means**2)
+    # Too few frequencies in the ring to estimate a variance
+    anisotropies[:, counts < 8] = np.nan
+    return (means, anisotropies)
+
+
+def summarize(levels, spectra, radius, principals, means, anisotropies):
+    """Gathers the scores of each level and the mean scores (cf analyze_2d)."""
+
+    analysis = {"levels": []}
+    for (k, level) in enumerate(levels):
+        low = (radius > 0) & (radius < principals[k] / 2)
+        result = {"level": level,
+                  "low_frequency": None,
+                  "anisotropy_db": None,
+                  "radial_spectrum": [None if math.isnan(x) else float(x)
+                                      for x in means[k]]}
+        if np.any(low):
+            result["low_frequency"] = float(spectra[k][low].mean()
+                                            / spectra[k][radius > 0].mean())
+        if anisotropies is not None:
+            result["anisotropy_db"] = float(np.nanmean(anisotropies[k]))
+        analysis["levels"].append(result)
+
+    for name in ("low_frequency", "anisotropy_db"):
+        values = [result[name] for result in analysis["levels"]
+                  if result[name] is not None]
+        analysis[name] = float(np.mean(values)) if values else None
+
+    analysis["passed"] = (
+        (analysis["low_frequency"] is None
+         or analysis["low_frequency"] <= MAX_LOW_FREQUENCY)
+        and (analysis["anisotropy_db"] is None
+             or analysis["anisotropy_db"] <= MAX_ANISOTROPY))
+    return analysis
+
+
+def print_analysis(name, analysis):
+    """Prints the scores of an analysis."""
+
+    def score(value, unit=""):
+        return "-" if value is None else "%.3f%s" % (value, unit)
+
+    print("%s: low-frequency ratio %s, anisotropy %s: %s"
+          % (name, score(analysis["low_frequency"]),
+             score(analysis["anisotropy_db"], " dB"),
+             "PASS" if analysis["passed"] else "FAIL"))
+    for result in analysis["levels"]:
+        print("    level %.2f: low-frequency ratio %s, anisotropy %s"
+              % (result["level"], score(result["low_frequency"]),
+                 score(result["anisotropy_db"], " dB")))
+
+
+if __name__ == "__main__":
+    main()
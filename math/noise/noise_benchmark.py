@@ -0,0 +1,236 @@
+##############################################################################
+#                                                                            #
+#  Written in 2017 by Louis Sugy                                             #
+#                                                                            #
+#  License : CC-BY                                                           #
+#                                                                            #
+##############################################################################
+
+# This program measures the noise tools of this folder: the 1d and 2d
+# blue-noise generators, the brownian noise generator and the dithering, for
+# a grid of sizes, sigmas and blur distances, with fixed seeds.
+
+# HOWTO: python3 noise_benchmark.py results.json [baseline.json]
+# The results (time and memory of each case) are saved in results.json,
+# which can be used later as a baseline. If a baseline is given, the cases
+# which got slower or bigger than the tolerances are reported, and the
+# program exits with an error code.
+
+# Each case is run in a new Python process, so that the peak memory (maximum
+# resident set size, from the resource module) only measures this case.
+
+
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import resource
+import numpy as np
+
+
+# Parameters of the cases
+SIZES_2D = [32, 64, 128]
+ROWS_1D = 64
+SIZES_1D = [64, 256]
+SIGMAS = [1.5, 1.9]
+BLUR_DISTS = [8, 16]
+IMAGE_SIZES = [64, 256]
+SEED = 1
+
+# Bigger 2d textures, only measured with the first sigma and blur distance,
+# to show how the time grows with the size
+LARGE_SIZES_2D = [256, 512]
+
+# Engines and row lengths of the brownian noise generator
+BROWNIAN_ENGINES = ["smoother", "spectral", "stream"]
+BROWNIAN_SIZES = [256, 2**14]
+
+# Number of runs of each case, the fastest one is kept
+REPEATS = 3
+
+# A case is a regression if it is slower than the baseline by more than
+# TIME_TOLERANCE (relatively) and MIN_SECONDS (absolutely), or if the memory
+# it uses beyond the interpreter and the imports (extra_memory_kb) is bigger
+# by more than MEMORY_TOLERANCE (relatively) and MIN_MEMORY_KB (absolutely).
+TIME_TOLERANCE = 0.2
+MIN_SECONDS = 0.05
+MEMORY_TOLERANCE = 0.2
+MIN_MEMORY_KB = 1024
+
+
+def main():
+    out_filename = sys.argv[1]
+    baseline_filename = sys.argv[2] if len(sys.argv) > 2 else None
+
+    results = []
+    for case in cases():
+        result = run_case(case)
+        print("%-60s %8.3f s %10d kB" % (case_name(case), result["seconds"],
+                                         result["extra_memory_kb"]))
+        results.append(result)
+
+    with open(out_filename, 'w') as f:
+        json.dump({"python": sys.version.split()[0],
+                   "numpy": np.__version__,
+                   "results": results}, f, indent=2)
+
+    if baseline_filename is not None:
+        with open(baseline_filename, 'r') as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline)
+        for message in regressions:
+            print("REGRESSION: " + message)
+        if regressions:
+            sys.exit(1)
+
+
+def cases():
+    """Returns the list of the cases to measure."""
+
+    cases = []
+    for sigma in SIGMAS:
+        for blur_dist in BLUR_DISTS:
+            for size in SIZES_2D:
+                cases.append({"tool": "blue_noise_2d", "width": size,
+                              "height": size, "sigma": sigma,
+                              "blur_dist": blur_dist})
+            for size in SIZES_1D:
+                cases.append({"tool": "blue_noise_1d", "rows": ROWS_1D,
+                              "values": size, "sigma": sigma,
+                              "blur_dist": blur_dist})
+    for size in LARGE_SIZES_2D:
+        cases.append({"tool": "blue_noise_2d", "width": size, "height": size,
+                      "sigma": SIGMAS[0], "blur_dist": BLUR_DISTS[0]})
+    for engine in BROWNIAN_ENGINES:
+        for size in BROWNIAN_SIZES:
+            cases.append({"tool": "brownian_noise_1d", "engine": engine,
+                          "rows": ROWS_1D, "values": size})
+    for size in IMAGE_SIZES:
+        cases.append({"tool": "noise_dithering", "width": size,
+                      "height": size, "bit_depth": 2})
+    return cases
+
+
+def case_name(case):
+    """Returns a short description of a case."""
+
+    return " ".join([case["tool"]] + ["%s=%s" % (key, case[key])
+                                      for key in sorted(case)
+                                      if key != "tool"])
+
+
+def run_case(case):
+    """Runs a case in a new process and returns its results."""
+
+    output = subprocess.run([sys.executable, __file__, "--case",
+                             json.dumps(case)],
+                            check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.splitlines()[-1])
+    result["case"] = case
+    return result
+
+
+def measure(case):
+    """Runs a case in the current process, REPEATS times, and returns the
+       time of the fastest run and the peak memory."""
+
+    start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seconds = min(time_case(case) for _ in range(REPEATS))
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        (start_memory, peak_memory) = (start_memory // 1024,
+                                       peak_memory // 1024)
+
+    return {"seconds": seconds,
+            "peak_memory_kb": peak_memory,
+            "extra_memory_kb": peak_memory - start_memory}
+
+
+def time_case(case):
+    """Runs a case once, non-interactively, and returns its duration."""
+
+    random.seed(SEED)
+    tool = case["tool"]
+
+    if tool == "blue_noise_2d":
+        import blue_noise_generator_2d as generator
+        kernel = generator.make_kernel(case["sigma"], case["blur_dist"])
+        start = time.perf_counter()
+        generator.generate(case["width"], case["height"], kernel, SEED)
+
+    elif tool == "blue_noise_1d":
+        import blue_noise_generator_1d as generator
+        kernel = generator.make_kernel(case["sigma"], case["blur_dist"])
+        start = time.perf_counter()
+        list(generator.generate_rows(case["rows"], case["values"], kernel,
+                                     SEED))
+
+    elif tool == "brownian_noise_1d":
+        import brownian_noise_generator_1d as generator
+        generator.ENGINE = case["engine"]
+        start = time.perf_counter()
+        for chunks in generator.generate_row_chunks(case["rows"],
+                                                    case["values"], SEED):
+            for _ in chunks:
+                pass
+
+    elif tool == "noise_dithering":
+        import png
+        import noise_dithering
+        (width, height) = (case["width"], case["height"])
+        image = [[random.randrange(256) for _ in range(3 * width)]
+                 for _ in range(height)]
+        noise = [np.array([[random.randrange(65536) for _ in range(64)]
+                           for _ in range(64)]) for _ in range(3)]
+        # The image goes through the PNG files, like in noise_dithering
+        with tempfile.TemporaryDirectory() as directory:
+            img_filename = os.path.join(directory, "image.png")
+            with open(img_filename, "wb") as f:
+                png.Writer(width, height, greyscale=False).write(f, image)
+            start = time.perf_counter()
+            noise_dithering.dither_file(img_filename,
+                                        os.path.join(directory, "new.png"),
+                                        noise, case["bit_depth"])
+            return time.perf_counter() - start
+
+    else:
+        raise ValueError("Unknown tool: " + tool)
+
+    return time.perf_counter() - start
+
+
+def compare(results, baseline):
+    """Compares results to a baseline and returns the list of the
+       regressions, as messages."""
+
+    reference = {json.dumps(result["case"], sort_keys=True): result
+                 for result in baseline}
+    regressions = []
+    for result in results:
+        old = reference.get(json.dumps(result["case"], sort_keys=True))
+        if old is None:
+            continue
+        name = case_name(result["case"])
+        if (result["seconds"] > old["seconds"] * (1 + TIME_TOLERANCE)
+                and result["seconds"] - old["seconds"] > MIN_SECONDS):
+            regressions.append("%s: %.3f s instead of %.3f s"
+                               % (name, result["seconds"], old["seconds"]))
+        if (result["extra_memory_kb"]
+                > old["extra_memory_kb"] * (1 + MEMORY_TOLERANCE)
+                and result["extra_memory_kb"] - old["extra_memory_kb"]
+                    > MIN_MEMORY_KB):
+            regressions.append("%s: %d kB instead of %d kB"
+                               % (name, result["extra_memory_kb"],
+                                  old["extra_memory_kb"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--case":
+        print(json.dumps(measure(json.loads(sys.argv[2]))))
+    else:
+        main()
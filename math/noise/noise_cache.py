@@ -0,0 +1,109 @@
+##############################################################################
+#                                                                            #
+#  Written in 2017 by Louis Sugy                                             #
+#                                                                            #
+#  License : CC-BY                                                           #
+#                                                                            #
+##############################################################################
+
+# This module keeps the noise arrays computed by the generators in an on-disk
+# cache, so that asking again for the same noise (same generator, same
+# parameters, same seed) returns it instantly instead of recomputing it.
+
+# The entries are .npy files named after a hash of the parameters, which must
+# include the version of the algorithm. When the cache gets bigger than
+# CACHE_SIZE, the least recently used entries are removed.
+
+
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+
+# Directory of the cache (None to disable it)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "noise")
+
+# Maximum total size of the cache, in bytes
+CACHE_SIZE = 2**30
+
+
+def cached(kind, params, compute):
+    """Returns the array of the given kind of noise for the given parameters
+       (a dictionary of JSON values) from the cache. On a miss, the array is
+       computed by calling compute() and stored in the cache."""
+
+    if CACHE_DIR is None:
+        return np.asarray(compute())
+
+    array = load(kind, params)
+    if array is None:
+        array = np.asarray(compute())
+        store(kind, params, array)
+    return array
+
+
+def entry_path(kind, params):
+    """Returns the path of the cache entry of the given noise."""
+
+    key = json.dumps([kind, params], sort_keys=True)
+    return os.path.join(CACHE_DIR,
+                        hashlib.sha256(key.encode()).hexdigest() + ".npy")
+
+
+def load(kind, params):
+    """Returns the cached array (memory-mapped, read-only) of the given
+       noise, or None if it is not in the cache."""
+
+    path = entry_path(kind, params)
+    try:
+        array = np.load(path, mmap_mode="r")
+    except FileNotFoundError:
+        return None
+
+    # The modification time is used as the time of last use
+    os.utime(path)
+    return array
+
+
+def store(kind, params, array):
+    """Stores an array in the cache, then evicts the least recently used
+       entries if needed. The file is written under a temporary name and
+       then renamed, so that readers never see a partial entry."""
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    (fd, tmp_path) = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, entry_path(kind, params))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    evict(CACHE_SIZE)
+
+
+def evict(max_size):
+    """Removes the least recently used entries until the total size of the
+       cache is at most max_size bytes."""
+
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".npy"):
+            try:
+                stat = os.stat(os.path.join(CACHE_DIR, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for (_, size, _) in entries)
+    for (_, size, name) in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(os.path.join(CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+        total -= size
@@ -16,83 +16,309 @@
 # For the moment it is impossible to specify the color palette, that could be
 # a improvement of this code.
 
-# /!\ The program only works with png images.
+# /!\ The program only works with png images. Greyscale images stay greyscale
+# (only the noise texture for red is used), and the alpha channel is kept
+# (rescaled to the new bit depth, without dithering). The noise textures can be
+# PNG images, or tables in any format of noise_io (the binary ones are
+# memory-mapped instead of being decoded). If a noise texture has several
+# channels (e.g. a RGBA texture of blue_noise_generator_2d), the red uses its
+# first channel, the green its second one and the blue its third one, so the
+# same texture can be given for the 3 colors. An empty filename means the
+# same texture as for red.
 
+# The image is dithered row by row while it is read, and each dithered row is
+# written immediately, so only a few rows are in memory at a time: the size
+# of the image is not limited by the memory.
 
+# The original image can also be a directory of PNG frames (e.g. the frames
+# of a video): they are dithered in the order of their filenames, in WORKERS
+# processes, and saved with the same filenames in the new directory. The
+# noise textures are only decoded once, and the noise is offset from a frame
+# to the next (cf FRAME_OFFSET), so that the dithering pattern does not stay
+# still in the animation.
+
+
+import functools
+import math
+import multiprocessing
+import os
+import weakref
 import png
+import numpy as np
+import noise_io
+
+
+# Number of processes dithering the frames of a directory
+WORKERS = 1
+
+# Offset of the noise for the frame f of a directory:
+#  - "golden": the values of the noise are shifted by f / phi times their
+#    range (modulo the range), phi being the golden ratio. Each frame keeps
+#    the pattern of the noise, and the thresholds of each pixel are evenly
+#    spread over the frames.
+#  - "spatial": the noise textures are shifted by f * (1 / g, 1 / g**2)
+#    times their size (modulo their size), g being the plastic number, so
+#    that the shifts are evenly spread over the texture.
+#  - None: the same noise for all the frames.
+FRAME_OFFSET = "golden"
 
 
 def main():
     """Lets the user choose an image to be dithered, the targeted bit depth
        and the noise textures to use."""
 
-    img_filename = input("Original image filename: ")
-    new_filename = input("New image filename: ")
+    img_filename = input("Original image filename (or directory of frames): ")
+    new_filename = input("New image filename (or directory): ")
     bit_depth = int(input("Bit depth: "))
 
     R_filename = input("Noise texture for red: ")
     G_filename = input("Noise texture for green: ")
     B_filename = input("Noise texture for blue: ")
 
-    try:
-        img = png.Reader(filename = img_filename).asRGB()
-        img_mat = list(img[2])
-    except:
-    	img = png.Reader(filename = img_filename).asRGBA()
-    	img_mat = list(img[2])
-    	img_mat = [[line[i] for i in range(len(line)) if i % 4 != 3]
-                                for line in img_mat]
-    old_depth = img[3]['bitdepth']
+    RGB_noise = load_noises((R_filename, G_filename or R_filename,
+                             B_filename or R_filename))
+
+    if os.path.isdir(img_filename):
+        dither_frames(img_filename, new_filename, RGB_noise, bit_depth)
+    else:
+        dither_file(img_filename, new_filename, RGB_noise, bit_depth)
+
+
+def load_noises(filenames):
+    """Loads the noise textures of the channels with noise_io, as 2d arrays,
+       each file being loaded once. If a texture has several channels, the
+       channel c uses its channel c (modulo the number of channels)."""
+
+    tables = {}
+    noise = []
+    for (channel, filename) in enumerate(filenames):
+        if filename not in tables:
+            tables[filename] = noise_io.load(filename)
+        table = tables[filename]
+        if table.ndim == 3:
+            table = table[:, :, channel % table.shape[2]]
+        noise.append(table)
+    return noise
+
+
+def dither_file(img_filename, new_filename, noise, bit_depth, shift=(0, 0)):
+    """Dithers an image with the noise textures of the red, green and blue
+       (cf dither_rows for the shift), and saves it with the given
+       filename."""
+
+    # The image is decoded once, whatever its type: asDirect gives rows of
+    # grey or RGB values, followed by the alpha if there is one.
+    (width, height, img_rows, info) = png.Reader(
+        filename = img_filename).asDirect()
+    old_depth = info['bitdepth']
+    alpha = info['alpha']
+    colors = info['planes'] - alpha
+
+    new_rows = dither_rows(img_rows, width, noise[:colors], old_depth,
+                           bit_depth, alpha, shift)
+    writer = png.Writer(width, height, greyscale=colors == 1, alpha=alpha,
+                        bitdepth=bit_depth)
+    with open(new_filename, "wb") as f:
+        writer.write(f, new_rows)
+
+
+def dither_frames(directory, new_directory, noise, bit_depth):
+    """Dithers the PNG frames of a directory, in the order of their
+       filenames, with the noise offset for each frame (cf FRAME_OFFSET),
+       and saves them in new_directory. The frames are distributed among
+       WORKERS processes."""
+
+    os.makedirs(new_directory, exist_ok=True)
+    filenames = sorted(filename for filename in os.listdir(directory)
+                       if filename.lower().endswith(".png"))
+    tasks = [(frame, os.path.join(directory, filename),
+              os.path.join(new_directory, filename))
+             for (frame, filename) in enumerate(filenames)]
+
+    if WORKERS <= 1:
+        init_frame_worker(noise, bit_depth)
+        for task in tasks:
+            dither_frame(task)
+    else:
+        with multiprocessing.Pool(WORKERS, init_frame_worker,
+                                  (noise, bit_depth)) as pool:
+            for _ in pool.imap_unordered(dither_frame, tasks):
+                pass
+
+
+# State of the processes of dither_frames (cf init_frame_worker)
+frame_state = {}
+
+
+def init_frame_worker(noise, bit_depth):
+    """Initializes a process of the pool of dither_frames."""
+
+    frame_state["noise"] = noise
+    frame_state["bit_depth"] = bit_depth
+
+
+def dither_frame(task):
+    """Dithers a frame of dither_frames, given by its number, its filename
+       and its new filename."""
+
+    (frame, img_filename, new_filename) = task
+    (noise, shift) = frame_noise(frame_state["noise"], frame)
+    dither_file(img_filename, new_filename, noise, frame_state["bit_depth"],
+                shift)
+
+
+def frame_noise(noise, frame):
+    """Returns the noise textures of the given frame and the shift of the
+       textures (cf FRAME_OFFSET)."""
+
+    if FRAME_OFFSET == "golden":
+        fraction = frame * (math.sqrt(5) - 1) / 2 % 1
+        shifted = {}
+        for texture in noise:
+            if id(texture) not in shifted:
+                top = int(texture.max()) + 1
+                shifted[id(texture)] = ((texture.astype(np.int64)
+                                         + int(fraction * top)) % top)
+        return ([shifted[id(texture)] for texture in noise], (0, 0))
+
+    if FRAME_OFFSET == "spatial":
+        # Plastic number, the real root of x**3 = x + 1
+        g = 1.32471795724474602596
+        (height, width) = np.shape(noise[0])
+        return (noise, (int(frame / g % 1 * height),
+                        int(frame / g**2 % 1 * width)))
+
+    return (noise, (0, 0))
+
+
+def dither_rows(rows, width, noise, old_depth, bit_depth, alpha=False,
+                shift=(0, 0)):
+    """Dithers rows given by an iterable (in flat pixel format, or as
+       (width, channels) arrays) to the given bit depth, with one noise
+       texture per channel, and yields the dithered rows one at a time, in
+       flat pixel format, as soon as they are read.
+       With step = 2**(old_depth - bit_depth), written den / num, the value
+       v with the noise n becomes
+       (v + step * n / noise_max) // step
+           = (v * num + k) // den     with k = (den * n) // noise_max,
+       clamped to 2**bit_depth - 1. The offsets k are computed once per
+       noise texture (cf noise_table) and the divisions and the clamp once
+       per bit depths (cf quantization_table), so each value is only a
+       lookup in a table. The textures are repeated over the image: the row
+       i is dithered with the rows (i + shift[0]) % noise_height of the
+       noise textures, from their column shift[1].
+       If alpha is True, the pixels have an alpha value after their
+       channels, which is only rescaled to the new bit depth."""
+
+    (table, num, channels) = dither_setup(noise, old_depth, bit_depth, width,
+                                          shift[1])
+    alpha_table = rescale_table(old_depth, bit_depth)
+    planes = len(channels) + alpha
+
+    for (i, row) in enumerate(rows):
+        pixels = np.asarray(row).reshape(width, planes)
+        new_row = np.empty((width, planes), dtype=row_type(bit_depth))
+        for (c, (offsets, cols)) in enumerate(channels):
+            indices = pixels[:, c].astype(np.int32) * num
+            indices += offsets[(i + shift[0]) % offsets.shape[0], cols]
+            new_row[:, c] = table[indices]
+        if alpha:
+            new_row[:, -1] = alpha_table[pixels[:, -1]]
+        yield new_row.ravel()
+
+
+def row_type(bit_depth):
+    """Type of the rows given to png.Writer: it expects bytes up to 8 bits."""
+
+    return np.uint8 if bit_depth <= 8 else np.uint16
+
+
+def rescale(values, old_depth, bit_depth):
+    """Rescales values of old_depth bits to bit_depth bits (rounded), the
+       maximum staying the maximum."""
+
+    old_max = 2**old_depth - 1
+    return ((values.astype(np.int64) * (2**bit_depth - 1) + old_max // 2)
+            // old_max)
+
+
+def depth_ratio(old_depth, bit_depth):
+    """Returns the step 2**(old_depth - bit_depth) as a fraction (num, den)
+       of powers of 2 (cf dither_rows)."""
+
+    return (2**max(bit_depth - old_depth, 0), 2**max(old_depth - bit_depth, 0))
+
+
+@functools.lru_cache(maxsize=None)
+def quantization_table(old_depth, bit_depth):
+    """Returns the table of the dithered values (cf dither_rows), indexed by
+       v * num + k, and num."""
 
-    R_noise = list(png.Reader(filename = R_filename).read()[2])
-    G_noise = list(png.Reader(filename = G_filename).read()[2])
-    B_noise = list(png.Reader(filename = B_filename).read()[2])
+    (num, den) = depth_ratio(old_depth, bit_depth)
+    indices = np.arange((2**old_depth - 1) * num + den + 1)
+    table = np.minimum(indices // den, 2**bit_depth - 1)
+    table = table.astype(row_type(bit_depth))
+    table.flags.writeable = False
+    return (table, num)
 
-    RGB_noise = (R_noise, G_noise, B_noise)
 
-    new_mat = dither(img_mat, RGB_noise, old_depth, bit_depth)
-    save_image(new_mat, new_filename, bit_depth)
+@functools.lru_cache(maxsize=None)
+def rescale_table(old_depth, bit_depth):
+    """Returns the table of the rescaled values of the alpha channel."""
 
+    table = rescale(np.arange(2**old_depth), old_depth, bit_depth)
+    table = table.astype(row_type(bit_depth))
+    table.flags.writeable = False
+    return table
 
 
-def dither(matrix, noise, old_depth, bit_depth):
-    """Dithers the given matrix -in flat row flat pixel format- with the given
-       bit depth and noise -3 channels format-."""
+# Offsets of the noise textures (cf noise_table), by id of the texture and
+# bit depths. An entry is removed when its texture is deleted, so a texture
+# used for several images is only processed once.
+noise_tables = {}
 
-    height = len(matrix)
-    width = len(matrix[0]) // 3
-    noise_height = [len(noise[c]) for c in range(3)]
-    noise_width = [len(noise[c][0]) // 3 for c in range(3)]
 
-    noise_max = [max(noise[c][i][j] for i in range(noise_height[c])
-                                    for j in range(noise_width[c])) 
-                                    for c in range(3)]
-    max_val = 2**bit_depth
-    
-    step = 2**(old_depth - bit_depth)
+def noise_table(texture, old_depth, bit_depth):
+    """Returns the offsets k = (den * n) // noise_max of a noise texture (cf
+       dither_rows). The offsets of the arrays are kept in noise_tables, the
+       textures being expected not to change."""
 
-    new_matrix = [[[0]*3 for j in range(width)] for i in range(height)]
+    if not isinstance(texture, np.ndarray):
+        texture = np.asarray(texture)
+        key = None
+    else:
+        key = (id(texture), old_depth, bit_depth)
+        entry = noise_tables.get(key)
+        if entry is not None and entry[0]() is texture:
+            return entry[1]
 
-    for i in range(height):
-        for j in range(width):
-            for c in range(3):
-                new_matrix[i][j][c] = (
-                    (matrix[i][3*j + c]
-                     + step * noise[c][i%noise_height[c]][j%noise_width[c]] / noise_max[c])
-                    // step
-                )
-                if new_matrix[i][j][c] >= max_val:
-                    new_matrix[i][j][c] = max_val - 1
+    (num, den) = depth_ratio(old_depth, bit_depth)
+    noise_max = int(texture.max())
+    offsets = ((den * texture.astype(np.int64)) // noise_max).astype(np.int32)
+    offsets.flags.writeable = False
 
-    return new_matrix
+    if key is not None:
+        reference = weakref.ref(texture,
+                                lambda _: noise_tables.pop(key, None))
+        noise_tables[key] = (reference, offsets)
+    return offsets
 
-    
 
-def save_image(matrix, filename, bit_depth):
-    """Saves the given matrix in a RGB image with the given filename."""
+def dither_setup(noise, old_depth, bit_depth, width, column=0):
+    """Returns the table of the dithered values and num (cf
+       quantization_table), and for each channel, the offsets of its noise
+       texture and the columns of the texture matching the columns of the
+       image, from the given column of the texture."""
 
-    png.from_array(matrix, "RGB;" + str(bit_depth)).save(filename)
+    (table, num) = quantization_table(old_depth, bit_depth)
+    channels = []
+    for texture in noise:
+        offsets = noise_table(texture, old_depth, bit_depth)
+        channels.append((offsets, (np.arange(width) + column)
+                                   % offsets.shape[1]))
+    return (table, num, channels)
 
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
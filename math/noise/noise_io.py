@@ -0,0 +1,104 @@
+##############################################################################
+#                                                                            #
+#  Written in 2017 by Louis Sugy                                             #
+#                                                                            #
+#  License : CC-BY                                                           #
+#                                                                            #
+##############################################################################
+
+# This module reads and writes the noise tables of the tools of this folder
+# (rows of 1d noise or 2d textures). The format is given by the extension of
+# the filename:
+#  - .csv (or any other extension): text, one row per line, with the values
+#    separated by ';'
+#  - .png: greyscale (or colour) image
+#  - .npy: NumPy array
+#  - .noise: raw values in little-endian order, after a small header
+#
+# The .npy and .noise files can be memory-mapped, so the tools reading them
+# do not have to parse anything.
+
+# Header of the .noise files (16 bytes, followed by the dimensions):
+#  - the magic string "NOISE\0"
+#  - the version of the format (1 byte)
+#  - the number of dimensions d (1 byte)
+#  - the type of the values, as a NumPy type string padded with spaces
+#    (4 bytes, e.g. "<u4 " for 32-bit unsigned integers)
+#  - 4 bytes of padding
+#  - the d dimensions, as 64-bit unsigned integers
+# The values follow in row-major order.
+
+
+import os
+import struct
+import numpy as np
+import png
+
+
+MAGIC = b"NOISE\0"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<6sBB4s4x")
+
+BINARY_EXTENSIONS = (".npy", ".noise")
+
+
+def is_binary(filename):
+    """True if the given file is in a binary format (.npy or .noise)."""
+
+    return os.path.splitext(filename)[1].lower() in BINARY_EXTENSIONS
+
+
+def create(filename, shape, dtype):
+    """Creates a binary noise file and returns it as a writable
+       memory-mapped array of the given shape and type, so that it can be
+       filled row by row."""
+
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if filename.lower().endswith(".npy"):
+        return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype,
+                                         shape=tuple(shape))
+
+    with open(filename, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(shape),
+                            dtype.str.ljust(4).encode("ascii")))
+        f.write(struct.pack("<%dQ" % len(shape), *shape))
+    return np.memmap(filename, dtype=dtype, mode="r+",
+                     offset=HEADER.size + 8 * len(shape), shape=tuple(shape))
+
+
+def save(filename, array):
+    """Saves an array in a binary noise file."""
+
+    array = np.asarray(array)
+    table = create(filename, array.shape, array.dtype)
+    table[...] = array
+    table.flush()
+
+
+def load(filename):
+    """Loads a noise table. The binary files are memory-mapped read-only.
+       The images are returned as (height, width) arrays, or (height, width,
+       planes) arrays if they have several channels."""
+
+    extension = os.path.splitext(filename)[1].lower()
+
+    if extension == ".npy":
+        return np.load(filename, mmap_mode="r")
+
+    if extension == ".noise":
+        with open(filename, "rb") as f:
+            (magic, version, ndim, dtype) = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(filename + " is not a noise file")
+            shape = struct.unpack("<%dQ" % ndim, f.read(8 * ndim))
+        return np.memmap(filename, dtype=np.dtype(dtype.decode().strip()),
+                         mode="r", offset=HEADER.size + 8 * ndim, shape=shape)
+
+    if extension == ".png":
+        (width, height, rows, info) = png.Reader(filename=filename).read()
+        image = np.vstack([np.asarray(row) for row in rows])
+        if info["planes"] > 1:
+            image = image.reshape(height, width, info["planes"])
+        return image
+
+    return np.loadtxt(filename, delimiter=";", dtype=np.int64, ndmin=2)
@@ -0,0 +1,49 @@
+##############################################################################
+#                                                                            #
+#  Written in 2017 by Louis Sugy                                             #
+#                                                                            #
+#  License : CC-BY                                                           #
+#                                                                            #
+##############################################################################
+
+# This module gives the random generators of the noise tools of this folder.
+# All the random values of a noise come from one master seed, from which an
+# independent stream is derived for each part of the noise (a row, a tile, a
+# channel...) with a key, e.g. stream(seed, "row", 12). A part then does not
+# depend on the order in which the parts are computed, nor on the number of
+# processes computing them: the noise only depends on the seed, so it can be
+# cached, checkpointed and computed in parallel.
+
+
+import hashlib
+import json
+import random
+import secrets
+import numpy as np
+
+
+def new_seed():
+    """Returns a new random master seed, for the noises generated without a
+       seed."""
+
+    return secrets.randbits(63)
+
+
+def derive(seed, *key):
+    """Returns the 256-bit integer derived from a master seed and a key (JSON
+       values)."""
+
+    data = json.dumps([seed] + list(key)).encode()
+    return int.from_bytes(hashlib.sha256(data).digest(), "little")
+
+
+def stream(seed, *key):
+    """Returns the random.Random generator of the given part of a noise."""
+
+    return random.Random(derive(seed, *key))
+
+
+def numpy_stream(seed, *key):
+    """Returns the NumPy generator of the given part of a noise."""
+
+    return np.random.default_rng(derive(seed, *key))